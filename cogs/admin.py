@@ -24,7 +24,9 @@ class Admin(commands.Cog):
         """ Reloads all cogs """
         async with ctx.typing():
             ctx.bot.reload_extension('cogs.admin')
+            ctx.bot.reload_extension('cogs.web')
             ctx.bot.reload_extension('cogs.database')
+            ctx.bot.reload_extension('cogs.cache')
             ctx.bot.reload_extension('cogs.dota')
             ctx.bot.reload_extension('cogs.error_handler')
             ctx.bot.reload_extension('cogs.youtube')
@@ -0,0 +1,398 @@
+""" Audio sources used by the music player """
+import asyncio
+import audioop
+import collections
+import json
+import math
+import mmap
+import os
+import shlex
+import struct
+import subprocess
+import threading
+
+import discord
+from discord.oggparse import OggStream
+
+
+FRAME_SIZE = 3840  # bytes in 20ms of 48kHz 16-bit stereo PCM
+BLOCK_SIZE = 65536 # bytes fed to FFmpeg at a time
+
+LOUDNESS_TARGET = -16.0 # integrated loudness in LUFS
+TRUE_PEAK_LIMIT = -1.0  # dBTP
+LOUDNORM_FILTER = f"loudnorm=I={LOUDNESS_TARGET}:TP={TRUE_PEAK_LIMIT}"
+
+# Packet store: <magic> <packet count> <count + 1 offsets> <packets>, little endian
+PACKET_MAGIC = b"OPK1"
+PACKET_HEADER = struct.Struct("<4sI")
+PACKET_OFFSET = struct.Struct("<I")
+PACKET_BITRATE = "128k"
+PACKET_VOLUME = 20 # player volume (%) baked into the packets, the default guild volume
+
+
+async def measure_loudness(path, executable="ffmpeg"):
+    """ Runs the analysis pass of FFmpeg's loudnorm filter on a file.
+
+    Returns:
+        A tuple of (integrated loudness in LUFS, true peak in dBTP), or None if FFmpeg failed.
+    """
+    process = await asyncio.create_subprocess_exec(
+        executable, "-hide_banner", "-nostats", "-i", path, "-vn",
+        "-af", f"{LOUDNORM_FILTER}:print_format=json", "-f", "null", "-",
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        return None
+
+    # The measurements are the last JSON object FFmpeg prints
+    text = stderr.decode(errors="replace")
+    try:
+        stats = json.loads(text[text.rindex("{"):text.rindex("}") + 1])
+        return float(stats["input_i"]), float(stats["input_tp"])
+    except (ValueError, KeyError):
+        return None
+
+def loudness_gain(loudness, true_peak):
+    """ Returns the gain in dB that brings a song to LOUDNESS_TARGET without pushing
+    its peaks over TRUE_PEAK_LIMIT.
+    """
+    gain = min(LOUDNESS_TARGET - loudness, TRUE_PEAK_LIMIT - true_peak)
+    if not math.isfinite(gain):
+        return 0.0 # silence
+    return round(gain, 2)
+
+
+class LoudnessAnalyzer:
+    """ Measures the loudness of downloaded songs in the background, one at a time.
+
+    Each file is analyzed once and the gain is handed to `save`, so playback can use
+    a cheap volume filter instead of running loudnorm on every play.
+
+    Args:
+        loop: The event loop.
+        save: Coroutine function called with (youtube_id, gain in dB).
+    """
+    def __init__(self, loop, save, workers=1):
+        self.save = save
+        self.queue = asyncio.Queue()
+        self.queued = set() # youtube_ids waiting or being analyzed
+        self._workers = [loop.create_task(self._work()) for _ in range(workers)]
+
+    def analyze(self, youtube_id, path):
+        """ Queues a file for analysis, unless it already is """
+        if youtube_id not in self.queued:
+            self.queued.add(youtube_id)
+            self.queue.put_nowait((youtube_id, path))
+
+    async def _work(self):
+        while True:
+            youtube_id, path = await self.queue.get()
+            try:
+                measured = await measure_loudness(path)
+                if measured is not None:
+                    await self.save(youtube_id, loudness_gain(*measured))
+            except Exception as error: # pylint: disable=broad-except
+                print(f"Loudness analysis of {path} failed: {error}")
+            finally:
+                self.queued.discard(youtube_id)
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+
+
+async def encode_packets(source, path, gain, executable="ffmpeg"):
+    """ Transcodes an audio file once into a packet store of 20ms Opus frames.
+
+    The loudness gain and PACKET_VOLUME are applied before encoding, so the packets
+    can go straight to the voice client (see PacketAudio).
+
+    Returns:
+        The size of the packet store in bytes, or None if FFmpeg failed.
+    """
+    ogg_path = path + ".ogg"
+    process = await asyncio.create_subprocess_exec(
+        executable, "-hide_banner", "-nostats", "-loglevel", "error", "-y", "-i", source, "-vn",
+        "-af", f"volume={gain}dB,volume={PACKET_VOLUME / 100}",
+        "-ar", "48000", "-ac", "2", "-c:a", "libopus", "-b:a", PACKET_BITRATE,
+        "-frame_duration", "20", "-application", "audio", "-f", "ogg", ogg_path,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, stderr = await process.communicate()
+    try:
+        if process.returncode != 0:
+            print(f"Encoding {source} failed: {stderr.decode(errors='replace').strip()}")
+            return None
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, write_packets, ogg_path, path)
+    finally:
+        try:
+            os.remove(ogg_path)
+        except FileNotFoundError:
+            pass
+
+def write_packets(ogg_path, path):
+    """ Unpacks the Opus packets of an Ogg file into a packet store. Runs on a worker thread.
+
+    Returns:
+        The size of the packet store in bytes.
+    """
+    with open(ogg_path, "rb") as file:
+        packets = list(OggStream(file).iter_packets())
+    # Skip the OpusHead and OpusTags headers
+    packets = [packet for packet in packets if not packet.startswith((b"OpusHead", b"OpusTags"))]
+
+    offset = PACKET_HEADER.size + PACKET_OFFSET.size * (len(packets) + 1)
+    offsets = [offset]
+    for packet in packets:
+        offset += len(packet)
+        offsets.append(offset)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(PACKET_HEADER.pack(PACKET_MAGIC, len(packets)))
+        file.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        file.writelines(packets)
+    os.replace(temp_path, path)
+    return offset
+
+
+class PacketAudio(discord.AudioSource):
+    """ Plays a packet store written by encode_packets().
+
+    The Opus packets are read from a memory map and handed to the voice client as they
+    are, so there is no FFmpeg process, no volume scaling and no Opus encoding per frame.
+    Finding a frame is a single lookup in the offset index, which makes seeking O(1).
+
+    Args:
+        path: The packet store.
+        position: Seconds into the song to start at.
+    """
+    def __init__(self, path, position=0):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = PACKET_HEADER.unpack_from(self._map)
+        if magic != PACKET_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a packet store")
+        self.frames = 0 # 20ms frames read so far, from the start of the song
+        self.seek(position)
+
+    def is_opus(self):
+        return True
+
+    def seek(self, position):
+        """ Moves playback to `position` seconds into the song """
+        self.frames = max(0, min(int(position * 50), self.count))
+
+    def read(self):
+        if self.frames >= self.count:
+            return b''
+        start, end = struct.unpack_from("<2I", self._map, PACKET_HEADER.size + PACKET_OFFSET.size * self.frames)
+        self.frames += 1
+        return self._map[start:end]
+
+    def cleanup(self):
+        self._map.close()
+
+
+class GaplessAudio(discord.AudioSource):
+    """ Plays one song after another through a single vc.play().
+
+    The next song's source is opened and primed ahead of time with set_next(), and
+    read() switches to it on the frame after the current song's last frame, so there
+    is no gap between songs. Optionally the last `crossfade` frames of a PCM song are
+    mixed with the start of the next one.
+
+    Args:
+        source: The first song's audio source.
+        on_next: Called from the voice thread after switching to the next source.
+        on_prime: Called from the voice thread when the current song reaches `prime_at`.
+        prime_at: Frame of the current song at which to call on_prime, or None.
+        crossfade: Number of 20ms frames to crossfade over, 0 for a hard cut.
+    """
+    def __init__(self, source, on_next=None, on_prime=None, prime_at=None, crossfade=0):
+        self._lock = threading.Lock()
+        self.source = source  # current song
+        self.next = None      # next song, set by set_next()
+        self.frames = 0       # frames of the current song played
+        self.crossfade = crossfade
+        self._on_next = on_next
+        self._on_prime = on_prime
+        self._prime_at = prime_at
+        self._next_first = b''   # first frame of the next song, read when it was primed
+        self._next_prime_at = None
+        self._ahead = collections.deque() # frames of the current song read ahead, for crossfading
+        self._ended = False      # the current song has no frames left past _ahead
+        self._faded = 0          # frames of the next song already mixed into this one
+
+    def is_opus(self):
+        return self.source.is_opus()
+
+    def set_next(self, source, first_frame=b'', prime_at=None):
+        """ Sets the source to switch to when the current one ends, None to clear it.
+
+        Args:
+            first_frame: The first frame, already read from `source` to prime it.
+            prime_at: The next song's frame at which to call on_prime.
+        Returns:
+            True if a next source was replaced, False if there was none, e.g. because
+            read() already switched to it.
+        """
+        with self._lock:
+            old = self.next
+            self.next = source
+            self._next_first = first_frame
+            self._next_prime_at = prime_at
+        if old is not None:
+            old.cleanup()
+        return old is not None
+
+    def replace(self, source, prime_at=None):
+        """ Replaces the current source, e.g. to play the song from a new position.
+        The frame count starts over from the new source.
+        """
+        with self._lock:
+            old = self.source
+            self.source = source
+            self.frames = 0
+            self._prime_at = prime_at
+            self._ahead.clear()
+            self._ended = False
+        old.cleanup()
+
+    def _read_next(self):
+        if self._next_first:
+            data, self._next_first = self._next_first, b''
+            return data
+        return self.next.read()
+
+    def _read_current(self):
+        if not self.crossfade or self.source.is_opus():
+            return self.source.read()
+
+        # Stay `crossfade` frames ahead, so we know when the song is about to end
+        while not self._ended and len(self._ahead) <= self.crossfade:
+            data = self.source.read()
+            if not data:
+                self._ended = True
+            else:
+                self._ahead.append(data)
+        if not self._ahead:
+            return b''
+        data = self._ahead.popleft()
+
+        # In the last frames, fade out into the next song
+        if self._ended and self.next is not None and not self.next.is_opus():
+            incoming = self._read_next()
+            if len(incoming) == len(data):
+                weight = (len(self._ahead) + 1) / (self.crossfade + 1)
+                data = audioop.add(audioop.mul(data, 2, weight), audioop.mul(incoming, 2, 1 - weight), 2)
+                self._faded += 1
+        return data
+
+    def read(self):
+        with self._lock:
+            data = self._read_current()
+            if data:
+                self.frames += 1
+                if self._prime_at is not None and self.frames >= self._prime_at:
+                    self._prime_at = None
+                    if self._on_prime is not None:
+                        self._on_prime()
+                return data
+
+            # The current song ended, switch to the next one on this very frame
+            if self.next is None:
+                return b''
+            old = self.source
+            self.source, self.next = self.next, None
+            data, self._next_first = self._next_first, b''
+            self.frames = self._faded
+            self._faded = 0
+            self._prime_at = self._next_prime_at
+            self._ahead.clear()
+            self._ended = False
+            old.cleanup()
+            if self._on_next is not None:
+                self._on_next()
+
+            if not data:
+                data = self._read_current()
+            if data:
+                self.frames += 1
+            return data
+
+    def cleanup(self):
+        with self._lock:
+            sources = [self.source, self.next]
+            self.next = None
+        for source in sources:
+            if source is not None:
+                source.cleanup()
+
+
+class StreamingAudio(discord.AudioSource):
+    """ Plays an audio file that is still being downloaded.
+
+    A feeder thread pipes the file into FFmpeg as it grows, and closes FFmpeg's input
+    once the download has finished, so playback can start after the first few KB
+    instead of after the whole file. If the download fails partway, whatever was
+    downloaded is played and the song ends there.
+
+    Args:
+        path: The file being written by the download.
+        finished: threading.Event set when the download is done (or failed).
+        executable: FFmpeg executable.
+        options: Extra FFmpeg output options, e.g. audio filters.
+    """
+    def __init__(self, path, finished, executable="ffmpeg", options=""):
+        self.frames = 0 # 20ms frames read so far
+        args = [executable, "-i", "pipe:0", "-f", "s16le", "-ar", "48000", "-ac", "2",
+                "-loglevel", "warning", *shlex.split(options), "pipe:1"]
+        # Raises FileNotFoundError if the download finished and moved the file already
+        self._file = open(path, "rb")
+        try:
+            self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            self._file.close()
+            raise discord.ClientException(executable + " was not found.") from None
+        self._feeder = threading.Thread(target=self._feed, args=(finished,), daemon=True)
+        self._feeder.start()
+
+    def _feed(self, finished):
+        """ Copies the file into FFmpeg's stdin until the download is done """
+        stdin = self._process.stdin
+        try:
+            while True:
+                data = self._file.read(BLOCK_SIZE)
+                if data:
+                    stdin.write(data)
+                elif finished.is_set():
+                    # The download may have written a last block before finishing
+                    stdin.write(self._file.read())
+                    break
+                elif self._process.poll() is not None:
+                    break
+                else:
+                    finished.wait(0.1)
+        except (OSError, ValueError):
+            # FFmpeg was killed or the file was closed by cleanup()
+            pass
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+            self._file.close()
+
+    def read(self):
+        data = self._process.stdout.read(FRAME_SIZE)
+        if len(data) != FRAME_SIZE:
+            return b''
+        self.frames += 1
+        return data
+
+    def cleanup(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
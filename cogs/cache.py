@@ -0,0 +1,265 @@
+""" Audio cache: keeps the downloaded songs under a size budget """
+import asyncio
+import os
+import time
+
+from discord.ext import commands
+
+from cogs.audio import LoudnessAnalyzer, encode_packets
+from cogs.music import AUDIO_DIRECTORY, audio_path, packet_path
+
+
+CACHE_BUDGET = 50 * 1024 ** 3 # bytes of audio to keep on disk
+CACHE_LOW_WATER = 0.9         # evict down to this fraction of the budget
+CACHE_POLICY = "lru"          # "lru" evicts the least recently played, "lfu" the least played
+INDEX_FLUSH_INTERVAL = 60     # seconds between writes of the index
+
+# Checks
+async def author_is_plomdawg(ctx):
+    """ Returns True if the author is plomdawg """
+    return ctx.author.id == 163040232701296641
+
+def save_entries(connection, entries):
+    connection.executemany("INSERT OR REPLACE INTO audio_cache VALUES (?,?,?,?)", entries)
+
+def delete_entries(connection, youtube_ids):
+    connection.executemany("DELETE FROM audio_cache WHERE youtube_id = ?",
+                           [(youtube_id,) for youtube_id in youtube_ids])
+
+def scan_directory(index):
+    """ Reconciles the index with the files on disk. Runs on a worker thread.
+
+    Files from the old flat ./songs/<id>.mp3 layout are moved into their shard. The size
+    of a song includes its packet store, if it has one.
+
+    Args:
+        index: dict of youtube_id -> [size, last access, plays] loaded from the database.
+    Returns:
+        A tuple of (entries to add or update, youtube_ids to delete from the index).
+    """
+    os.makedirs(AUDIO_DIRECTORY, exist_ok=True)
+    # Move the flat files first, so the shards they go to are only scanned once
+    flat = [entry for entry in os.scandir(AUDIO_DIRECTORY) if entry.is_file() and entry.name.endswith(".mp3")]
+    for entry in flat:
+        path = audio_path(entry.name[:-len(".mp3")])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(entry.path, path)
+
+    sizes = {} # key = youtube_id, value = {extension: size}
+    for entry in os.scandir(AUDIO_DIRECTORY):
+        if entry.is_dir():
+            for file in os.scandir(entry.path):
+                youtube_id, extension = os.path.splitext(file.name)
+                if file.is_file() and extension in (".mp3", ".opk"):
+                    sizes.setdefault(youtube_id, {})[extension] = file.stat().st_size
+    found = {youtube_id: sum(files.values()) for youtube_id, files in sizes.items()} # key = youtube_id, value = size
+
+    now = time.time()
+    changed = []
+    for youtube_id, size in found.items():
+        entry = index.get(youtube_id)
+        if entry is None:
+            changed.append((youtube_id, size, now, 0))
+        elif entry[0] != size:
+            changed.append((youtube_id, size, entry[1], entry[2]))
+    missing = [youtube_id for youtube_id in index if youtube_id not in found]
+    return changed, missing
+
+
+class AudioCache(commands.Cog):
+    """ Index of the downloaded audio files with a byte budget.
+
+    The index (size, last access and play count of every file) lives in memory and
+    in the audio_cache table. When the files go over CACHE_BUDGET, the least recently
+    (or least frequently) played files are deleted, except for pinned ones: songs
+    that are playing or being prefetched.
+
+    New files are measured for loudness and then transcoded into an Opus packet
+    store, which the player uses instead of FFmpeg when it can.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.budget = CACHE_BUDGET
+        self.policy = CACHE_POLICY
+        self.index = {} # key = youtube_id, value = [size, last access, plays]
+        self.pins = {}  # key = youtube_id, value = number of players holding it
+        self.dirty = set() # youtube_ids changed since the last write of the index
+        self.usage = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loaded = False
+        self._evicting = False
+        self.loudness = LoudnessAnalyzer(bot.loop, self.analyzed)
+        self.bot.loop.create_task(self.load())
+        self._flush_task = self.bot.loop.create_task(self.run())
+
+    def cog_unload(self):
+        self._flush_task.cancel()
+        self.loudness.close()
+        self.flush_nowait()
+
+    async def load(self):
+        """ Loads the index and reconciles it with the files on disk """
+        rows = await self.bot.db.storage.fetchall("SELECT youtube_id, size, last_access, plays FROM audio_cache")
+        index = {row[0]: list(row[1:]) for row in rows}
+        changed, missing = await self.bot.loop.run_in_executor(None, scan_directory, index)
+        for youtube_id, size, last_access, plays in changed:
+            index[youtube_id] = [size, last_access, plays]
+        for youtube_id in missing:
+            del index[youtube_id]
+        await self.bot.db.storage.write(save_entries, changed)
+        await self.bot.db.storage.write(delete_entries, missing)
+
+        # keep anything added while we were loading
+        index.update(self.index)
+        self.index = index
+        self.usage = sum(entry[0] for entry in index.values())
+        self.loaded = True
+        print(f"Audio cache: {len(index)} files, {self.usage / 1024 ** 3:.1f} GB")
+        await self.evict()
+
+    def contains(self, youtube_id, play=False):
+        """ Returns True if a song's file is cached.
+
+        Args:
+            play: True if the song is about to be played, counts towards the hit rate,
+                  the last access time and the play count.
+        """
+        entry = self.index.get(youtube_id)
+        if entry is None and not self.loaded and os.path.isfile(audio_path(youtube_id)):
+            return True
+
+        if play:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                entry[1] = time.time()
+                entry[2] += 1
+                self.dirty.add(youtube_id)
+        return entry is not None
+
+    async def add(self, youtube_id):
+        """ Adds a newly downloaded file to the index, then evicts if over budget """
+        if youtube_id in self.index:
+            return
+        path = audio_path(youtube_id)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        self.index[youtube_id] = [size, time.time(), 0]
+        self.usage += size
+        self.dirty.add(youtube_id)
+        self.analyze(youtube_id)
+        if self.usage > self.budget:
+            await self.evict()
+
+    def analyze(self, youtube_id):
+        """ Queues a cached file for loudness analysis (see LoudnessAnalyzer) """
+        self.loudness.analyze(youtube_id, audio_path(youtube_id))
+
+    async def analyzed(self, youtube_id, gain):
+        """ Saves a song's measured gain, then builds its packet store with it """
+        await self.bot.db.set_gain(youtube_id, gain)
+        if youtube_id not in self.index or os.path.isfile(packet_path(youtube_id)):
+            return
+        size = await encode_packets(audio_path(youtube_id), packet_path(youtube_id), gain)
+        entry = self.index.get(youtube_id)
+        if size is None:
+            return
+        if entry is None:
+            # Evicted while encoding
+            await self.bot.loop.run_in_executor(None, remove_files, [packet_path(youtube_id)])
+            return
+        entry[0] += size
+        self.usage += size
+        self.dirty.add(youtube_id)
+
+    def pin(self, youtube_id):
+        """ Protects a song's file from eviction until unpin() is called """
+        self.pins[youtube_id] = self.pins.get(youtube_id, 0) + 1
+
+    def unpin(self, youtube_id):
+        count = self.pins.get(youtube_id, 0) - 1
+        if count > 0:
+            self.pins[youtube_id] = count
+        else:
+            self.pins.pop(youtube_id, None)
+
+    async def evict(self):
+        """ Deletes unpinned files until usage is under CACHE_LOW_WATER of the budget """
+        if self.usage <= self.budget or self._evicting:
+            return
+        self._evicting = True
+        try:
+            if self.policy == "lfu":
+                key = lambda item: (item[1][2], item[1][1]) # fewest plays, then oldest
+            else:
+                key = lambda item: item[1][1] # oldest access
+            candidates = sorted((item for item in self.index.items() if item[0] not in self.pins), key=key)
+
+            target = self.budget * CACHE_LOW_WATER
+            evicted = []
+            for youtube_id, entry in candidates:
+                if self.usage <= target:
+                    break
+                evicted.append(youtube_id)
+                self.usage -= entry[0]
+                del self.index[youtube_id]
+                self.dirty.discard(youtube_id)
+
+            paths = [path(youtube_id) for youtube_id in evicted for path in (audio_path, packet_path)]
+            await self.bot.loop.run_in_executor(None, remove_files, paths)
+            await self.bot.db.storage.write(delete_entries, evicted)
+            self.evictions += len(evicted)
+            print(f"Audio cache: evicted {len(evicted)} files")
+        finally:
+            self._evicting = False
+
+    def _take_dirty(self):
+        entries = [(youtube_id, *self.index[youtube_id]) for youtube_id in self.dirty if youtube_id in self.index]
+        self.dirty = set()
+        return entries
+
+    async def flush(self):
+        """ Writes changed index entries to the database """
+        entries = self._take_dirty()
+        if entries:
+            await self.bot.db.storage.write(save_entries, entries)
+
+    def flush_nowait(self):
+        entries = self._take_dirty()
+        if entries:
+            self.bot.db.storage.submit(save_entries, entries)
+
+    async def run(self):
+        """ Writes the index every INDEX_FLUSH_INTERVAL seconds """
+        while True:
+            await asyncio.sleep(INDEX_FLUSH_INTERVAL)
+            await self.flush()
+
+    @commands.command()
+    @commands.check(author_is_plomdawg)
+    async def cache(self, ctx):
+        """ Sends the audio cache usage and hit rate """
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        text = f"Usage: **{self.usage / 1024 ** 3:.2f}** / {self.budget / 1024 ** 3:.0f} GB\n"
+        text += f"Files: **{len(self.index)}** ({len(self.pins)} pinned)\n"
+        text += f"Hit rate: **{hit_rate:.1f}%** ({self.hits} hits, {self.misses} misses)\n"
+        text += f"Evicted: **{self.evictions}** files ({self.policy.upper()})"
+        await self.bot.send_embed(channel=ctx, title="Audio Cache", text=text)
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def setup(bot):
+    bot.add_cog(AudioCache(bot))
+    print("Loaded AudioCache cog")
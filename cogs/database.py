@@ -1,10 +1,25 @@
+import asyncio
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import discord
 from discord.ext import commands
 from cogs.music import Song
 
 
+DATABASE_PATH = "database.sqlite"
+READ_CONNECTIONS = 4 # size of the read connection pool
+FLUSH_SIZE = 200     # write buffered plays once this many songs are waiting
+FLUSH_INTERVAL = 60  # seconds between writes of buffered plays
+SEARCH_CACHE_SIZE = 10000         # search results kept in memory
+SEARCH_TTL = 30 * 24 * 60 * 60    # seconds before a cached search result is looked up again
+MAX_VARIABLES = 500               # values per query in bulk lookups (SQLite allows 999)
+
+# Schema version 1, see MIGRATIONS for the changes made since
 GUILDS = ("id INT",
           "prefix TEXT",
           "volume INT",
@@ -25,80 +40,622 @@ SONGS = ("title TEXT",
          "thumbnail TEXT",
         )
 
+SONG_COLUMNS = "title, duration, plays, query, spotify_id, youtube_id, thumbnail"
+PLAYER_COLUMNS = ("guild_id, voice_channel, text_channel, position, song_position, repeat, repeat_one, volume, "
+                  "shuffle_from, shuffle_to")
+QUEUE_COLUMNS = "guild_id, idx, title, duration, plays, query, spotify_id, youtube_id, thumbnail, url, user_id"
+
 async def author_is_plomdawg(ctx):
     """ Returns True if the author is plomdawg """
     return ctx.author.id == 163040232701296641
 
+def normalize_query(query):
+    """ Case-folds a search query and collapses whitespace and punctuation, so that
+    "Daft Punk - One More Time" and "daft punk  one more time!" are the same query.
+    """
+    words = re.split(r"[\W_]+", query.casefold())
+    return " ".join(word for word in words if word)
+
+def row_to_song(row):
+    """ Converts a row of SONG_COLUMNS to a Song() """
+    song = Song()
+    song.title = row[0]
+    song.duration = row[1]
+    song.plays = row[2]
+    song.query = row[3]
+    song.spotify_id = row[4]
+    song.youtube_id = row[5]
+    song.thumbnail = row[6]
+    song.url = song.youtube_url
+    return song
+
+
+class Storage:
+    """ Runs every SQLite call on a background thread so the event loop never blocks.
+
+    All writes go through a single writer thread (SQLite only allows one writer at a
+    time anyway) and reads are spread across a small pool of connections. The database
+    is in WAL mode, so readers are never blocked by a commit in progress.
+    """
+    def __init__(self, path=DATABASE_PATH, readers=READ_CONNECTIONS, setup=None):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        # WAL mode is persistent, set it (and create the schema) before any worker connects
+        connection = sqlite3.connect(self.path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        if setup is not None:
+            setup(connection)
+            connection.commit()
+        connection.close()
+
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer",
+                                          initializer=self._connect)
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader",
+                                           initializer=self._connect)
+
+    def _connect(self):
+        """ Opens the connection for the current worker thread """
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        self._local.connection = connection
+        with self._connections_lock:
+            self._connections.append(connection)
+
+    def _write(self, func, args):
+        connection = self._local.connection
+        with connection: # commits, or rolls back if func raises
+            return func(connection, *args)
+
+    def _read(self, func, args):
+        return func(self._local.connection, *args)
+
+    async def write(self, func, *args):
+        """ Runs func(connection, *args) in one transaction on the writer thread.
+
+        Returns:
+            Whatever func returns.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._writer, self._write, func, args)
+
+    async def read(self, func, *args):
+        """ Runs func(connection, *args) on one of the read connections.
+
+        Returns:
+            Whatever func returns.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._readers, self._read, func, args)
+
+    def submit(self, func, *args):
+        """ Queues func(connection, *args) on the writer thread without waiting for it.
+
+        Useful from synchronous code (e.g. cog_unload); close() waits for it to finish.
+        """
+        return self._writer.submit(self._write, func, args)
+
+    async def execute(self, query, values=()):
+        """ Executes a single write statement and commits. Returns the number of rows changed. """
+        return await self.write(lambda connection: connection.execute(query, values).rowcount)
+
+    async def fetchone(self, query, values=()):
+        """ Returns the first row of a SELECT, or None """
+        return await self.read(lambda connection: connection.execute(query, values).fetchone())
+
+    async def fetchall(self, query, values=()):
+        """ Returns all rows of a SELECT """
+        return await self.read(lambda connection: connection.execute(query, values).fetchall())
+
+    def close(self):
+        """ Waits for pending queries to finish and closes every connection """
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
+def create_tables(connection):
+    """ Create the original guilds, users and songs tables """
+    connection.execute(f"CREATE TABLE IF NOT EXISTS guilds ({','.join(GUILDS)})")
+    connection.execute(f"CREATE TABLE IF NOT EXISTS users ({','.join(USERS)})")
+    connection.execute(f"CREATE TABLE IF NOT EXISTS songs ({','.join(SONGS)})")
+
+def add_keys_and_indexes(connection):
+    """ Add primary keys to guilds/users, de-duplicate songs and index their lookups """
+    # guilds and users: keep the newest row for each id
+    for table, columns in (("guilds", "id INTEGER PRIMARY KEY, prefix TEXT, volume INT, music_channel TEXT"),
+                           ("users", "id INTEGER PRIMARY KEY, name TEXT, opendota_id INT")):
+        connection.execute(f"CREATE TABLE {table}_new ({columns})")
+        connection.execute(f"""INSERT INTO {table}_new SELECT * FROM {table}
+                               WHERE id IS NOT NULL
+                               AND rowid IN (SELECT MAX(rowid) FROM {table} GROUP BY id)""")
+        connection.execute(f"DROP TABLE {table}")
+        connection.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+    # songs: merge rows with the same youtube_id into the oldest one, summing the plays.
+    # The subqueries below look rows up by id, without an index they scan the table per row.
+    connection.execute("DELETE FROM songs WHERE youtube_id IS NULL")
+    connection.execute("CREATE INDEX songs_youtube_id_migration ON songs (youtube_id)")
+    connection.execute("CREATE INDEX songs_spotify_id_migration ON songs (spotify_id, plays DESC)")
+    connection.execute("""UPDATE songs SET plays = (SELECT SUM(COALESCE(plays, 0)) FROM songs AS s
+                                                    WHERE s.youtube_id = songs.youtube_id)
+                          WHERE rowid IN (SELECT MIN(rowid) FROM songs GROUP BY youtube_id
+                                          HAVING COUNT(*) > 1)""")
+    connection.execute("DELETE FROM songs WHERE rowid NOT IN (SELECT MIN(rowid) FROM songs GROUP BY youtube_id)")
+
+    # a spotify track maps to one video: keep the mapping on its most played row
+    connection.execute("""UPDATE songs SET spotify_id = NULL
+                          WHERE spotify_id IS NOT NULL AND rowid NOT IN (
+                              SELECT rowid FROM songs AS s WHERE s.spotify_id = songs.spotify_id
+                              ORDER BY plays DESC, rowid LIMIT 1)""")
+
+    # normalized query, see normalize_query()
+    connection.execute("ALTER TABLE songs ADD COLUMN query_key TEXT")
+    rows = connection.execute("SELECT rowid, query FROM songs WHERE query IS NOT NULL").fetchall()
+    connection.executemany("UPDATE songs SET query_key = ? WHERE rowid = ?",
+                           [(normalize_query(query), rowid) for rowid, query in rows])
+
+    connection.execute("DROP INDEX songs_youtube_id_migration")
+    connection.execute("DROP INDEX songs_spotify_id_migration")
+    connection.execute("CREATE UNIQUE INDEX songs_youtube_id ON songs (youtube_id)")
+    connection.execute("CREATE UNIQUE INDEX songs_spotify_id ON songs (spotify_id)")
+    connection.execute("CREATE INDEX songs_query_key ON songs (query_key)")
+
+def create_searches(connection):
+    """ Add the searches table caching YouTube search results """
+    connection.execute("""CREATE TABLE searches (query_key TEXT PRIMARY KEY, youtube_id TEXT,
+                                                 title TEXT, thumbnail TEXT, duration INT, created REAL)""")
+
+def create_audio_cache(connection):
+    """ Add the audio_cache table indexing the downloaded songs """
+    connection.execute("""CREATE TABLE audio_cache (youtube_id TEXT PRIMARY KEY, size INT,
+                                                    last_access REAL, plays INT)""")
+
+def add_song_gain(connection):
+    """ Add the gain column holding each song's loudness correction in dB """
+    connection.execute("ALTER TABLE songs ADD COLUMN gain REAL")
+
+def create_queues(connection):
+    """ Add the players and queue_songs tables holding queue snapshots """
+    connection.execute("""CREATE TABLE players (guild_id INTEGER PRIMARY KEY, voice_channel INT, text_channel INT,
+                                                position INT, song_position REAL, repeat INT, repeat_one INT,
+                                                volume REAL)""")
+    connection.execute("""CREATE TABLE queue_songs (guild_id INT, idx INT, title TEXT, duration INT, plays INT,
+                                                    query TEXT, spotify_id TEXT, youtube_id TEXT, thumbnail TEXT,
+                                                    url TEXT, user_id INT, PRIMARY KEY (guild_id, idx))""")
+
+def add_player_shuffle(connection):
+    """ Add the range of each saved queue that is still to be shuffled """
+    connection.execute("ALTER TABLE players ADD COLUMN shuffle_from INT NOT NULL DEFAULT 0")
+    connection.execute("ALTER TABLE players ADD COLUMN shuffle_to INT NOT NULL DEFAULT 0")
+
+def create_spotify_matches(connection):
+    """ Add the spotify_matches table mapping Spotify tracks to YouTube videos """
+    connection.execute("""CREATE TABLE spotify_matches (spotify_id TEXT PRIMARY KEY, youtube_id TEXT,
+                                                        thumbnail TEXT, created REAL)""")
+    # Keep the matches of songs that were already played
+    connection.execute("""INSERT INTO spotify_matches (spotify_id, youtube_id, thumbnail, created)
+                          SELECT spotify_id, youtube_id, thumbnail, CAST(strftime('%s', 'now') AS REAL) FROM songs
+                          WHERE spotify_id IS NOT NULL AND youtube_id IS NOT NULL""")
+
+def create_youtube_quota(connection):
+    """ Add the youtube_quota table holding each API key's usage of the day """
+    connection.execute("CREATE TABLE youtube_quota (key_id TEXT PRIMARY KEY, day TEXT, units INT, exhausted INT)")
+
+# Each migration upgrades the schema by one version. Only ever append to this list,
+# existing databases store the number of migrations already applied in user_version.
+MIGRATIONS = [
+    create_tables,
+    add_keys_and_indexes,
+    create_searches,
+    create_audio_cache,
+    add_song_gain,
+    create_queues,
+    create_spotify_matches,
+    add_player_shuffle,
+    create_youtube_quota,
+]
+
+def migrate(connection):
+    """ Upgrades the database to the latest schema version """
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        print(f"Migrating database to version {number}: {migration.__doc__.strip()}")
+        with connection:
+            migration(connection)
+            connection.execute(f"PRAGMA user_version = {number}")
+
+def upsert_guild(connection, guild_id, column, value):
+    """ Sets one column of a guild's row, creating the row if needed """
+    connection.execute(f"""INSERT INTO guilds (id, {column}) VALUES (?,?)
+                           ON CONFLICT (id) DO UPDATE SET {column} = excluded.{column}""",
+                       (guild_id, value))
+
+def save_plays(connection, plays):
+    """ Adds play counts to songs, inserting the songs that are not in the database yet.
+
+    Args:
+        plays: A list of [Song, number of new plays].
+    """
+    query = f"""INSERT INTO songs ({SONG_COLUMNS}, query_key) VALUES (?,?,?,?,?,?,?,?)
+                ON CONFLICT (youtube_id) DO UPDATE SET plays = plays + excluded.plays,
+                    query = COALESCE(excluded.query, query),
+                    query_key = COALESCE(excluded.query_key, query_key),
+                    title = COALESCE(title, excluded.title),
+                    duration = COALESCE(duration, excluded.duration),
+                    thumbnail = COALESCE(thumbnail, excluded.thumbnail)"""
+    for song, count in plays:
+        query_key = normalize_query(song.query) if song.query else None
+        values = [song.title, song.duration, count, song.query,
+                  song.spotify_id, song.youtube_id, song.thumbnail, query_key]
+        try:
+            connection.execute(query, values)
+        except sqlite3.IntegrityError:
+            # spotify_id is already matched to a different video, keep the existing match
+            values[4] = None
+            connection.execute(query, values)
+
+def save_gain(connection, youtube_id, gain):
+    """ Saves a song's loudness correction, adding a row for it if it has never been played """
+    connection.execute("""INSERT INTO songs (youtube_id, plays, gain) VALUES (?,0,?)
+                          ON CONFLICT (youtube_id) DO UPDATE SET gain = excluded.gain""",
+                       (youtube_id, gain))
+
+def save_snapshots(connection, snapshots):
+    """ Saves queue snapshots.
+
+    Args:
+        snapshots: A list of (guild_id, row of PLAYER_COLUMNS, queue change). The row is
+                   None to delete the guild's snapshot. The change is None if only the
+                   player row changed, see save_queue_change() otherwise.
+    """
+    for guild_id, player, change in snapshots:
+        if player is None:
+            connection.execute("DELETE FROM players WHERE guild_id = ?", (guild_id,))
+            connection.execute("DELETE FROM queue_songs WHERE guild_id = ?", (guild_id,))
+            continue
+        connection.execute(f"INSERT OR REPLACE INTO players ({PLAYER_COLUMNS}) VALUES (?,?,?,?,?,?,?,?,?,?)", player)
+        if change is not None:
+            save_queue_change(connection, guild_id, *change)
+
+def save_queue_change(connection, guild_id, moves, ranges):
+    """ Brings a guild's saved songs up to date with its queue.
+
+    Args:
+        moves: A list of (start, end, count), applied in order: the saved songs [start, end)
+               are deleted and the songs after them renumbered to make room for count
+               songs. end is None to delete every song from start on.
+        ranges: A list of (start, songs) to save at start, start + 1, ... The rows are
+                built here so the event loop only has to collect the songs.
+    """
+    for start, end, count in moves:
+        if end is None:
+            connection.execute("DELETE FROM queue_songs WHERE guild_id = ? AND idx >= ?", (guild_id, start))
+            continue
+        connection.execute("DELETE FROM queue_songs WHERE guild_id = ? AND idx >= ? AND idx < ?",
+                           (guild_id, start, end))
+        shift = start + count - end
+        if shift:
+            # Through negative indexes, so no row hits another's (guild_id, idx) on the way
+            connection.execute("UPDATE queue_songs SET idx = -1 - (idx + ?) WHERE guild_id = ? AND idx >= ?",
+                               (shift, guild_id, end))
+            connection.execute("UPDATE queue_songs SET idx = -1 - idx WHERE guild_id = ? AND idx < 0", (guild_id,))
+    for start, songs in ranges:
+        connection.executemany(f"INSERT OR REPLACE INTO queue_songs ({QUEUE_COLUMNS}) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                               (queue_row(guild_id, index, song) for index, song in enumerate(songs, start)))
+
+def queue_row(guild_id, index, song):
+    """ Returns a song's row of QUEUE_COLUMNS """
+    return (guild_id, index, song.title, song.duration, song.plays, song.query, song.spotify_id,
+            song.youtube_id, song.thumbnail, song.url, song.user_id)
+
+def load_snapshots(connection):
+    """ Returns a list of (row of PLAYER_COLUMNS, rows of QUEUE_COLUMNS in queue order) """
+    players = connection.execute(f"SELECT {PLAYER_COLUMNS} FROM players").fetchall()
+    songs = {}
+    for row in connection.execute(f"SELECT {QUEUE_COLUMNS} FROM queue_songs ORDER BY guild_id, idx"):
+        songs.setdefault(row[0], []).append(row)
+    return [(player, songs.get(player[0], [])) for player in players]
+
+def save_spotify_match(connection, spotify_id, youtube_id, thumbnail):
+    connection.execute("INSERT OR REPLACE INTO spotify_matches VALUES (?,?,?,?)",
+                       (spotify_id, youtube_id, thumbnail, time.time()))
+
+def find_spotify_matches(connection, spotify_ids):
+    """ Returns a dict of spotify_id -> (youtube_id, thumbnail) for the tracks that have a match """
+    matches = {}
+    for start in range(0, len(spotify_ids), MAX_VARIABLES):
+        chunk = spotify_ids[start:start + MAX_VARIABLES]
+        placeholders = ",".join("?" * len(chunk))
+        rows = connection.execute(f"""SELECT spotify_id, youtube_id, thumbnail FROM spotify_matches
+                                      WHERE spotify_id IN ({placeholders})""", chunk)
+        for spotify_id, youtube_id, thumbnail in rows:
+            matches[spotify_id] = (youtube_id, thumbnail)
+    return matches
+
+def upsert_user(connection, user_id, name, opendota_id):
+    connection.execute("INSERT OR REPLACE INTO users (id, name, opendota_id) VALUES (?,?,?)",
+                       (user_id, name, opendota_id))
+
+
+class PlayBuffer:
+    """ Write-behind buffer for song plays.
+
+    Plays are merged in memory (one entry per youtube_id) and written in a single
+    transaction once FLUSH_SIZE songs are waiting or every FLUSH_INTERVAL seconds,
+    instead of one commit per finished song.
+    """
+    def __init__(self, storage, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.storage = storage
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = {} # key = youtube_id, value = [Song, number of new plays]
+        self._flush_task = None
+
+    def add(self, song):
+        """ Records one play of a song """
+        entry = self.pending.get(song.youtube_id)
+        if entry is None:
+            self.pending[song.youtube_id] = [song, 1]
+        else:
+            entry[0] = song # keep the latest query
+            entry[1] += 1
+
+        if len(self.pending) >= self.flush_size and self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    def discard(self, youtube_id=None):
+        """ Drops buffered plays for one song, or all songs if youtube_id is None """
+        if youtube_id is None:
+            self.pending = {}
+        else:
+            self.pending.pop(youtube_id, None)
+
+    def _take(self):
+        plays = list(self.pending.values())
+        self.pending = {}
+        return plays
+
+    def _put_back(self, plays):
+        """ Returns plays that failed to save to the buffer, merged with the ones added since """
+        for song, count in plays:
+            entry = self.pending.get(song.youtube_id)
+            if entry is None:
+                self.pending[song.youtube_id] = [song, count]
+            else:
+                entry[1] += count
+
+    async def flush(self):
+        """ Writes all buffered plays in one transaction, keeping them buffered if it fails """
+        try:
+            plays = self._take()
+            if plays:
+                try:
+                    await self.storage.write(save_plays, plays)
+                except Exception as error: # pylint: disable=broad-except
+                    self._put_back(plays)
+                    print(f"Failed to save plays for {len(plays)} songs: {error}")
+                    return
+                print(f"Saved plays for {len(plays)} songs")
+        finally:
+            self._flush_task = None
+
+    def flush_nowait(self):
+        """ Queues the buffered plays on the writer thread (for shutdown) """
+        plays = self._take()
+        if plays:
+            self.storage.submit(save_plays, plays)
+
+    async def run(self):
+        """ Flushes the buffer every flush_interval seconds """
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+class SearchCache:
+    """ Caches YouTube search results by normalized query (see normalize_query).
+
+    The most recently used SEARCH_CACHE_SIZE results are kept in memory, and every
+    result is also saved in the searches table so it survives restarts. Results
+    older than SEARCH_TTL are treated as missing so they get refreshed.
+
+    A result is a tuple of (youtube_id, title, thumbnail, duration).
+    """
+    def __init__(self, storage, size=SEARCH_CACHE_SIZE, ttl=SEARCH_TTL):
+        self.storage = storage
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict() # key = query_key, value = (result, created)
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, query_key):
+        """ Returns the cached result for a normalized query, or None """
+        entry = self.entries.get(query_key)
+        if entry is None:
+            row = await self.storage.fetchone("""SELECT youtube_id, title, thumbnail, duration, created
+                                                 FROM searches WHERE query_key = ?""", (query_key,))
+            if row is not None:
+                entry = (row[:4], row[4])
+                self._remember(query_key, entry)
+
+        if entry is None or time.time() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(query_key)
+        self.hits += 1
+        return entry[0]
+
+    async def set(self, query_key, result):
+        """ Caches a search result in memory and in the database """
+        entry = (tuple(result), time.time())
+        self._remember(query_key, entry)
+        await self.storage.execute("INSERT OR REPLACE INTO searches VALUES (?,?,?,?,?,?)",
+                                   (query_key, *entry[0], entry[1]))
+
+    async def prune(self):
+        """ Deletes expired results from the database """
+        deleted = await self.storage.execute("DELETE FROM searches WHERE created < ?",
+                                             (time.time() - self.ttl,))
+        if deleted:
+            print(f"Deleted {deleted} expired search results")
+
+    def _remember(self, query_key, entry):
+        self.entries[query_key] = entry
+        self.entries.move_to_end(query_key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class GuildSettings:
+    """ In-memory copy of the guilds table.
+
+    Every row is loaded once at startup, after that lookups never touch the
+    database and changes are written through to it.
+    """
+    COLUMNS = ("prefix", "volume", "music_channel")
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.guilds = {} # key = guild.id, value = {column: value}
+        self.loaded = asyncio.Event()
+
+    async def load(self):
+        """ Loads every guild's settings. If that fails, the guilds get the default settings. """
+        try:
+            rows = await self.storage.fetchall(f"SELECT id, {', '.join(self.COLUMNS)} FROM guilds")
+        except Exception as error: # pylint: disable=broad-except
+            print(f"Failed to load guild settings, using the defaults: {error}")
+            return
+        finally:
+            # get() waits for this, even if the load failed
+            self.loaded.set()
+        for row in rows:
+            # keep anything that was set while we were loading
+            settings = dict(zip(self.COLUMNS, row[1:]))
+            settings.update(self.guilds.get(row[0], {}))
+            self.guilds[row[0]] = settings
+        print(f"Loaded settings for {len(rows)} guilds")
+
+    async def get(self, guild_id, column):
+        """ Returns one of a guild's settings, or None if it has not been set """
+        if not self.loaded.is_set():
+            await self.loaded.wait()
+        return self.guilds.get(guild_id, {}).get(column)
+
+    async def set(self, guild_id, column, value):
+        """ Changes one of a guild's settings and saves it """
+        if column not in self.COLUMNS:
+            raise ValueError(f"Unknown guild setting: {column}")
+        self.guilds.setdefault(guild_id, {})[column] = value
+        await self.storage.write(upsert_guild, guild_id, column, value)
+
+
 class Database(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.database = sqlite3.connect("database.sqlite")
-        self.cursor = self.database.cursor()
-        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS guilds ({','.join(GUILDS)})")
-        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS users ({','.join(USERS)})")
-        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS songs ({','.join(SONGS)})")
+        self.storage = Storage(setup=migrate)
+        self.plays = PlayBuffer(self.storage)
+        self.settings = GuildSettings(self.storage)
+        self.searches = SearchCache(self.storage)
+        self._plays_task = self.bot.loop.create_task(self.plays.run())
+        self.bot.loop.create_task(self.settings.load())
+        self.bot.loop.create_task(self.searches.prune())
+
+    def cog_unload(self):
+        self.close()
+
+    def close(self):
+        """ Writes buffered plays and closes the database. Safe to call more than once. """
+        self._plays_task.cancel()
+        self.plays.flush_nowait()
+        self.storage.close()
 
-    def find_song(self, query=None, youtube_id=None, spotify_id=None):
+    async def find_song(self, query=None, youtube_id=None, spotify_id=None):
         if query is not None:
-            _query = "SELECT * FROM songs WHERE query=?"
-            values = (query,)
+            _query = f"SELECT {SONG_COLUMNS} FROM songs WHERE query_key=?"
+            values = (normalize_query(query),)
         elif youtube_id is not None:
-            _query = "SELECT * FROM songs WHERE youtube_id=?"
+            _query = f"SELECT {SONG_COLUMNS} FROM songs WHERE youtube_id=?"
             values = (youtube_id,)
         elif spotify_id is not None:
-            _query = "SELECT * FROM songs WHERE spotify_id=?"
+            _query = f"SELECT {SONG_COLUMNS} FROM songs WHERE spotify_id=?"
             values = (spotify_id,)
         else:
             raise(Exception("find_song() called with missing parameter: query, youtube_id, or spotify_id"))
 
-        self.cursor.execute(_query, values)
-        result = self.cursor.fetchone()
-        if result is None:
-            return None            
-    
-        song = Song()
-        song.title = result[0]
-        song.duration = result[1]
-        song.plays = result[2]
-        song.query = result[3]
-        song.spotify_id = result[4]
-        song.youtube_id = result[5]
-        song.thumbnail = result[6]
-        song.url = song.youtube_url
+        result = await self.storage.fetchone(_query, values)
+        # rows without a title were only created to hold a gain, see save_gain()
+        if result is None or result[0] is None:
+            return None
+
+        song = row_to_song(result)
         print(f"Found cached youtube song in database: {song.title} ({song.plays} plays)")
-        return song       
-
-    def save_song(self, song):
-        query = f"SELECT * FROM songs WHERE youtube_id = ?"
-        self.cursor.execute(query, (song.youtube_id,))
-        result = self.cursor.fetchone()
-        if result is not None:
-            # Song already in database, update the play count
-            query = f"UPDATE songs SET plays = plays + 1, query = ? WHERE youtube_id = ?"
-            print(query)
-            self.cursor.execute(query, (song.query, song.youtube_id))
-            self.database.commit()
-            print("updated song", song.youtube_id, song.query, result)
-        else:
-            query = f"INSERT INTO songs (title, duration, plays, query, spotify_id, youtube_id, thumbnail) VALUES (?,?,?,?,?,?,?)"
-            self.cursor.execute(query, (song.title, song.duration, song.plays, song.query, song.spotify_id, song.youtube_id, song.thumbnail))
-            self.database.commit()
-            print("saved song", (song.title, song.duration, song.plays, song.query, song.spotify_id, song.youtube_id, song.thumbnail))
+        return song
+
+    async def save_song(self, song):
+        """ Counts one play of a song. The write is buffered, see PlayBuffer. """
+        self.plays.add(song)
+
+    async def get_guild_setting(self, guild_id, column):
+        """ Returns one of a guild's settings from the cache, or None if it has not been set """
+        return await self.settings.get(guild_id, column)
+
+    async def set_guild_setting(self, guild_id, column, value):
+        """ Updates one of a guild's settings in the cache and the database """
+        await self.settings.set(guild_id, column, value)
+
+    async def get_gain(self, youtube_id):
+        """ Returns a song's loudness correction in dB, or None if it has not been measured """
+        result = await self.storage.fetchone("SELECT gain FROM songs WHERE youtube_id = ?", (youtube_id,))
+        if result is None:
+            return None
+        return result[0]
 
-    def get_opendota_id(self, user):
+    async def set_gain(self, youtube_id, gain):
+        await self.storage.write(save_gain, youtube_id, gain)
+
+    async def save_spotify_match(self, spotify_id, youtube_id, thumbnail=None):
+        """ Remembers the YouTube video a Spotify track was matched to """
+        await self.storage.write(save_spotify_match, spotify_id, youtube_id, thumbnail)
+
+    async def find_spotify_matches(self, spotify_ids):
+        """ Looks up the YouTube matches of many Spotify tracks at once, see find_spotify_matches() """
+        spotify_ids = list({spotify_id for spotify_id in spotify_ids if spotify_id is not None})
+        if not spotify_ids:
+            return {}
+        return await self.storage.read(find_spotify_matches, spotify_ids)
+
+    async def save_snapshots(self, snapshots):
+        """ Saves queue snapshots, see save_snapshots() """
+        await self.storage.write(save_snapshots, snapshots)
+
+    def save_snapshots_nowait(self, snapshots):
+        """ Queues queue snapshots on the writer thread (for shutdown) """
+        self.storage.submit(save_snapshots, snapshots)
+
+    async def load_snapshots(self):
+        """ Returns the saved queue snapshots, see load_snapshots() """
+        return await self.storage.read(load_snapshots)
+
+    async def get_opendota_id(self, user):
         query = f"SELECT opendota_id FROM users WHERE id=?"
         values = (user.id, )
-        self.cursor.execute(query, values)
-        result = self.cursor.fetchone()
+        result = await self.storage.fetchone(query, values)
         if result is None:
             return None
         opendota_id = result[0]
         return opendota_id
 
-    def set_opendota_id(self, user, opendota_id):
-        query = f"INSERT OR REPLACE INTO users VALUES (?,?,?)"
-        values = (user.id, user.display_name, opendota_id)
-        self.cursor.execute(query, values)
+    async def set_opendota_id(self, user, opendota_id):
+        await self.storage.write(upsert_user, user.id, user.display_name, opendota_id)
 
     @commands.command()
     async def prefix(self, ctx, *args):
@@ -111,21 +668,8 @@ class Database(commands.Cog):
         # TODO: Validate prefix ?
         prefix = args[0]
 
-        # Update database
-        query = f"SELECT prefix FROM guilds WHERE id = ?"
-        self.cursor.execute(query, (ctx.guild.id,))
-        result = self.cursor.fetchone()
-        if result: # guild already in database, update ie
-            query = f"UPDATE guilds SET prefix = ? WHERE id = ?"
-            self.cursor.execute(query, (prefix, ctx.guild.id))
-        else:
-            query = f"INSERT INTO guilds (id, prefix, volume, music_channel) VALUES (?,?,?,?)"
-            self.cursor.execute(query, (ctx.guild.id, prefix, 20, None))
-
-        self.database.commit()
-
-        # Update cached prefixes
-        self.bot.prefixes[ctx.guild.id] = prefix
+        # Update cache and database
+        await self.set_guild_setting(ctx.guild.id, "prefix", prefix)
 
         # Reply with status
         await ctx.send(f"{ctx.author.display_name} changed the prefix to {prefix}")
@@ -133,42 +677,30 @@ class Database(commands.Cog):
     @commands.command()
     async def music(self, ctx, *args):
         """ Set the music channel for a guild """
-    
-        # Check database for current setting
-        query = "SELECT music_channel FROM guilds WHERE id = ?"
-        self.cursor.execute(query, (ctx.guild.id,))
-        result = self.cursor.fetchone()
-        print(query, "\nresult:", result)
-        if result:
-            if result[0] is None or int(result[0]) != ctx.channel.id:
-                # Set to new channel
-                query = "UPDATE guilds SET music_channel = ? WHERE id = ?"
-                self.cursor.execute(query, (ctx.channel.id, ctx.guild.id))
-                await ctx.send(f"{ctx.author.display_name} changed the music channel to **{ctx.channel.name}**. (Send again to unset)")
-            else:
-                music_channel_id = int(result[0])
-                query = "UPDATE guilds SET music_channel = ? WHERE id = ?"
-                print(music_channel_id, ctx.channel.id, (music_channel_id == ctx.channel.id))
-                if music_channel_id == ctx.channel.id:
-                    # Clear the music channel if sent in the current channel
-                    self.cursor.execute(query, (None, ctx.guild.id))
-                    await ctx.send(f"{ctx.author.display_name} unset the music channel.")
 
-        else:
+        # Check current setting
+        music_channel = await self.get_guild_setting(ctx.guild.id, "music_channel")
+        if music_channel is None:
             # No music channel was set - set it now
-            query = "INSERT INTO guilds (id, prefix, volume, music_channel) VALUES (?,?,?,?)"
-            self.cursor.execute(query, (ctx.guild.id, ctx.prefix, 20, ctx.channel.id))
+            await self.set_guild_setting(ctx.guild.id, "music_channel", ctx.channel.id)
             await ctx.send(f"{ctx.author.display_name} set **{ctx.channel.name}** as the music channel. (Send again to unset)")
-        
-        self.database.commit()
-    
+        elif int(music_channel) != ctx.channel.id:
+            # Set to new channel
+            await self.set_guild_setting(ctx.guild.id, "music_channel", ctx.channel.id)
+            await ctx.send(f"{ctx.author.display_name} changed the music channel to **{ctx.channel.name}**. (Send again to unset)")
+        else:
+            # Clear the music channel if sent in the current channel
+            await self.set_guild_setting(ctx.guild.id, "music_channel", None)
+            await ctx.send(f"{ctx.author.display_name} unset the music channel.")
+
     @commands.command()
     async def top(self, ctx, *args):
         """ Sends the top 10 most played songs"""
         async with ctx.typing():
-            query = f"SELECT youtube_id, title, plays FROM songs ORDER BY plays DESC LIMIT ?"
-            self.cursor.execute(query, (10,))
-            songs = self.cursor.fetchall()
+            await self.plays.flush()
+            # rows without a title only hold a gain, see save_gain()
+            query = f"SELECT youtube_id, title, plays FROM songs WHERE title IS NOT NULL ORDER BY plays DESC LIMIT ?"
+            songs = await self.storage.fetchall(query, (10,))
             text = ""
             for song in songs:
                 (youtube_id, title, plays) = song
@@ -180,8 +712,8 @@ class Database(commands.Cog):
     async def clear_plays(self, ctx, *args):
         """ Reset the plays for all songs """
         query = f"UPDATE songs SET plays = 0"
-        self.cursor.execute(query)
-        self.database.commit()
+        self.plays.discard()
+        await self.storage.execute(query)
         await ctx.send("Set plays to 0 for all songs.")
 
     @commands.command(aliases=["rm_song"])
@@ -193,17 +725,17 @@ class Database(commands.Cog):
             return
 
         youtube_id = args[0]
-        song = self.find_song(youtube_id=youtube_id)
+        song = await self.find_song(youtube_id=youtube_id)
 
         if song is None:
             await ctx.send(f"Failed to find {youtube_id} in the database.")
             return
 
         query = "DELETE FROM songs WHERE youtube_id=?"
-        self.cursor.execute(query, (youtube_id,))
-        self.database.commit()
+        self.plays.discard(youtube_id)
+        await self.storage.execute(query, (youtube_id,))
 
-        await ctx.send(f"Deleted {song[0]} from the database.")
+        await ctx.send(f"Deleted {song.title} from the database.")
 
 
 def setup(bot):
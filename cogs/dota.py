@@ -1,11 +1,9 @@
 """ Dota 2 cog """
 import asyncio
-import json
 from urllib.parse import quote
 
 import discord
 import opendota2py
-import requests
 from discord.ext import commands
 
 GAME_MODES = {
@@ -75,7 +73,6 @@ class Dota(commands.Cog):
         self.bot = bot
         self.quizzes = {}  # key = guild.id, value = Bool
         self.args = ('quiz',) # cache last args for NEW button
-        self.database = bot.get_cog('Database')
 
     # ;dota match
     async def last_match(self, ctx):
@@ -86,7 +83,7 @@ class Dota(commands.Cog):
             user = ctx.author
 
         # Get opendota ID from database
-        opendota_id = self.database.get_opendota_id(user)
+        opendota_id = await self.bot.db.get_opendota_id(user)
         
         # Missing from database, tell the user to fix it
         if opendota_id is None:
@@ -179,9 +176,8 @@ class Dota(commands.Cog):
 
         # Search opendota api
         query = " ".join(args[1:])
-        url = (f"https://api.opendota.com/api/search?q={quote(query)}")
-        response = requests.get(url)
-        results = json.loads(response.text)
+        url = "https://api.opendota.com/api/search"
+        results = await self.bot.web.get_json(url, params={"q": query})
 
         # Send search results
         #output = ""
@@ -218,7 +214,7 @@ class Dota(commands.Cog):
             result = results[:n][int(correct_msg.content)-1]
             response = await ctx.send(f"Selected {int(correct_msg.content)}. ({result['personaname']}) Saving account id {result['account_id']}.")
             # Save it to the database
-            self.database.set_opendota_id(ctx.author, result['account_id'])
+            await self.bot.db.set_opendota_id(ctx.author, result['account_id'])
             await self.bot.add_reactions(response, "👍")
 
             # Delete messages
@@ -239,7 +235,7 @@ class Dota(commands.Cog):
             opendota_id = int(args[1])
             # Save it to the database
             print(f"saving {ctx.author.display_name}'s opendota id: {opendota_id}")
-            self.database.set_opendota_id(ctx.author, opendota_id)
+            await self.bot.db.set_opendota_id(ctx.author, opendota_id)
             await ctx.send(f"Set opendota account ID to {opendota_id}.")
         except (IndexError, ValueError):
             text = f"""Usage: **{ctx.prefix}{ctx.command} [ID]**
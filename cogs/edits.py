@@ -0,0 +1,66 @@
+""" Coalesced edits of the messages the bot keeps up to date (queue, now playing, volume) """
+import asyncio
+
+import discord
+
+
+EDIT_INTERVAL = 1.5 # seconds between edits of one message
+
+
+class MessageEditor:
+    """ Edits one message, at most once every `interval` seconds.
+
+    update() only records how the message should look and returns right away. A task
+    sends the edit, then waits `interval` seconds; updates that come in meanwhile
+    replace each other, so a burst of skips or a big import ends in a single edit with
+    the latest state. Edits that would not change the embed are skipped.
+
+    Args:
+        message: The discord.Message to edit.
+        on_idle: Called with the editor when it has nothing left to send.
+    """
+    def __init__(self, message, interval=EDIT_INTERVAL, on_idle=None):
+        self.message = message
+        self.interval = interval
+        self.on_idle = on_idle
+        self.render = None # latest wanted state, see update()
+        self.task = None
+        self.edits = 0
+        self.skipped = 0
+
+    def update(self, render):
+        """ Sets the next state of the message.
+
+        Args:
+            render: Function given a copy of the message's embed, returning the embed to
+                    show. It runs just before the edit, so it sees the latest state.
+        """
+        self.render = render
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    def cancel(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self):
+        try:
+            while self.render is not None:
+                render, self.render = self.render, None
+                current = self.message.embeds[0] if self.message.embeds else discord.Embed()
+                embed = render(current.copy())
+                if embed.to_dict() == current.to_dict():
+                    self.skipped += 1
+                    continue
+                try:
+                    await self.message.edit(embed=embed)
+                except discord.errors.NotFound:
+                    return
+                except discord.errors.HTTPException as error:
+                    print(f"Failed to edit message {self.message.id}: {error}")
+                self.edits += 1
+                await asyncio.sleep(self.interval)
+        finally:
+            self.task = None
+            if self.on_idle is not None:
+                self.on_idle(self)
@@ -1,30 +1,74 @@
 import asyncio
 import os
-import random
+import sys
 import time
 
 import discord
-import lyricsgenius
+from bs4 import BeautifulSoup
 from discord.ext import commands
 
 import keys
+from cogs.audio import LOUDNORM_FILTER, PACKET_VOLUME, GaplessAudio, PacketAudio, StreamingAudio
+from cogs.quota import QuotaExceeded
+from cogs.songlist import SongList, changed_ranges
+
+PREFETCH_SONGS = 2 # number of upcoming songs to have downloaded before they play
+AUDIO_DIRECTORY = "./songs"
+STREAMING = True            # start playing songs that are not cached yet while they download
+STREAM_START_BYTES = 65536  # bytes to download before starting a stream
+PRIME_SECONDS = 5           # open the next song's audio this long before the current one ends
+CROSSFADE_SECONDS = 0       # overlap between songs, 0 to go straight from one to the next
+SNAPSHOT_INTERVAL = 10      # seconds between saves of the players' queues
+STATUS_INTERVAL = 2         # seconds into an import before the "queued N songs so far" message
+DISPLAY_TITLE_TABLE = str.maketrans(dict.fromkeys('[]()'))
+
+def audio_path(youtube_id):
+    """ Returns the path of a song's audio file, sharded by the first two characters of the id """
+    return f"{AUDIO_DIRECTORY}/{youtube_id[:2]}/{youtube_id}.mp3"
+
+def packet_path(youtube_id):
+    """ Returns the path of a song's Opus packet store, next to its audio file """
+    return f"{AUDIO_DIRECTORY}/{youtube_id[:2]}/{youtube_id}.opk"
 
 class Song:
+    # Queues can hold tens of thousands of songs, so no per-song __dict__
+    __slots__ = ("title", "duration", "position", "plays", "query", "_thumbnail", "_url",
+                 "youtube_id", "spotify_id", "user_id", "display_title")
+
     def __init__(self):
         self.title = None       # (str) Title
         self.duration = None    # (int) Duration in seconds
-        self.position = 0       # (int) Current position in song in seconds
+        self.position = 0       # (float) Seconds into the song that playback (re)started at
         self.plays = 0          # (int) Number of plays
         self.query = None       # (str) Search query that matched this song
         self.thumbnail = None   # (str) URL of thumbnail from YouTube API
         self.url = None         # (str) URL of song source
         self.youtube_id = None  # (str) ID of YouTube video
         self.spotify_id = None  # (str) ID of YouTube video
-        self.user = None # (discord.User) who requested this song
+        self.user_id = None     # (int) ID of the user who requested this song, see SongQueue.users
+        self.display_title = None # (str) title without brackets, for the queue message
+
+    # Thumbnails and URLs are often the same for many songs (e.g. the playlist they came
+    # from), interning them keeps one copy of each.
+    @property
+    def thumbnail(self):
+        return self._thumbnail
+
+    @thumbnail.setter
+    def thumbnail(self, value):
+        self._thumbnail = sys.intern(value) if value is not None else None
+
+    @property
+    def url(self):
+        return self._url
+
+    @url.setter
+    def url(self, value):
+        self._url = sys.intern(value) if value is not None else None
 
     @property
     def path(self):
-        return f"./songs/{self.youtube_id}.mp3"
+        return audio_path(self.youtube_id)
 
     @property
     def pretty_duration(self):
@@ -46,9 +90,17 @@ class Song:
 class SongQueue:
     def __init__(self, bot):
         self.bot = bot
-        self.songs = []
+        self.songs = SongList()
         self.position = 0
         self.queue_message = None
+        self.listeners = [] # functions called after the songs or position change
+        self.version = 0    # incremented whenever the songs change
+        self.users = {}     # key = user id, value = discord.Member who queued songs
+
+    def changed(self):
+        """ Notifies listeners that the songs or the position changed """
+        for listener in self.listeners:
+            listener()
 
     @property
     def next_song(self):
@@ -95,8 +147,10 @@ class SongQueue:
             # Add a triangle to the current song
             symbol = "⭄" if self.position == start + i else "--"
 
-            # Remove brackets from song title and limit length
-            title = song.title[:length].translate(str.maketrans(dict.fromkeys('[]()')))
+            # Title without brackets (see display_title), limit length
+            if song.display_title is None:
+                song.display_title = display_title(song)
+            title = song.display_title[:length]
 
             song_list += " {} {} [**{}**]({}) ({})\n".format(
                 symbol, start+i, title, song.url, duration)
@@ -108,20 +162,37 @@ class SongQueue:
 
     async def clear(self):
         self.position = 0
-        self.songs = []
+        self.songs = SongList()
+        self.users = {}
+        self.version += 1
+        self.changed()
         await self.update_queue_message()
 
-    async def queue(self, songs, user, insert=False):
-        """ Adds songs to the queue, if insert is true they will play next """
-        if insert:
-            for i, song in enumerate(songs):
-                song.user = user
-                self.songs.insert(self.position + 1 + i, song)
+    async def queue(self, songs, user, insert=False, index=None):
+        """ Adds songs to the queue, if insert is true they will play next.
+
+        Args:
+            index: Where to insert the songs instead, never before the next song.
+        Returns:
+            The index after the last added song, to add more songs behind them.
+        """
+        self.users[user.id] = user
+        for song in songs:
+            song.user_id = user.id
+            song.display_title = display_title(song)
+        if insert and index is None:
+            index = self.position + 1
+        if index is None:
+            self.songs.extend(songs)
+            end = len(self.songs)
         else:
-            for song in songs:
-                song.user = user
-                self.songs.append(song)
+            index = min(max(index, self.position + 1), len(self.songs))
+            self.songs.insert(index, songs)
+            end = index + len(songs)
+        self.version += 1
+        self.changed()
         await self.update_queue_message()
+        return end
 
     async def send_queue_message(self, channel):
         """ Deletes existing queue message and sends a new one.
@@ -148,34 +219,294 @@ class SongQueue:
     async def shuffle(self):
         """ Shuffles the songs beyond the current position """
         if len(self.songs) > self.position+1:
-            temp = self.songs[self.position+1:]
-            random.shuffle(temp)
-            self.songs[self.position+1:] = temp
+            self.songs.shuffle(self.position+1)
+            self.version += 1
+            self.changed()
             
         await self.update_queue_message()
 
+    async def remove(self, index):
+        """ Removes and returns the song at index. Raises IndexError if there is none. """
+        song = self.songs.pop(index)
+        if index < 0:
+            index += len(self.songs) + 1
+        # Keep pointing at the same song
+        if index < self.position:
+            self.position -= 1
+        self.version += 1
+        self.changed()
+        await self.update_queue_message()
+        return song
+
     async def update_queue_message(self):
-        """ Updates Queue message if it exists. """
+        """ Updates Queue message if it exists. The edit is coalesced (see MessageEditor),
+        the queue is formatted when it is sent.
+        """
         if self.queue_message is not None and self.queue_message.embeds:
-            embed = self.queue_message.embeds[0]
-            embed.description = self.format_queue()
+            self.bot.edit_message(self.queue_message, self.render_queue)
+
+    def render_queue(self, embed):
+        embed.description = self.format_queue()
+        return embed
+
+
+class Prefetcher:
+    """ Resolves and downloads the next few songs of a player's queue in the background,
+    so they are already on disk when their turn comes.
+
+    refresh() is called whenever the queue changes (queue, playnext, skip, shuffle,
+    remove...), it cancels the work for songs that are no longer coming up and starts
+    it for the ones that are. The upcoming songs are pinned in the audio cache so
+    they cannot be evicted before they play.
+    """
+    def __init__(self, player, count=PREFETCH_SONGS):
+        self.player = player
+        self.count = count
+        self.tasks = {} # key = id(song), value = asyncio.Task
+        self.pinned = set() # youtube_ids pinned in the audio cache
+
+    def upcoming(self):
+        """ Returns the songs that will play next, starting with the current one """
+        queue = self.player.queue
+        songs = []
+        for index in range(queue.position, queue.position + self.count + 1):
+            if index >= len(queue.songs):
+                if not self.player.repeat or not queue.songs:
+                    break
+                index %= len(queue.songs)
+            songs.append(queue.songs[index])
+        return songs
+
+    def refresh(self):
+        """ Starts prefetching the upcoming songs, cancelling songs that are no longer upcoming """
+        upcoming = {id(song): song for song in self.upcoming()}
+        for key in list(self.tasks):
+            if key not in upcoming:
+                self.tasks.pop(key).cancel()
+        for key, song in upcoming.items():
+            if key not in self.tasks:
+                self.tasks[key] = asyncio.ensure_future(self.prefetch(song))
+        self.update_pins()
+
+    def update_pins(self):
+        """ Pins the upcoming songs in the audio cache and unpins the rest """
+        cache = self.player.bot.audio_cache
+        upcoming = {song.youtube_id for song in self.upcoming() if song.youtube_id is not None}
+        for youtube_id in upcoming - self.pinned:
+            cache.pin(youtube_id)
+        for youtube_id in self.pinned - upcoming:
+            cache.unpin(youtube_id)
+        self.pinned = upcoming
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks = {}
+        self.update_pins()
+
+    async def prefetch(self, song):
+        try:
+            await self.player.youtube.load_song(song)
+            self.update_pins() # now that it has a youtube_id
+            await self.player.download_song(song, priority=self.player.youtube.downloads.PREFETCH)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            # play() will try again and report the error
+            print(f"Failed to prefetch {song.title}: {error}")
+
+
+class QueueSnapshots:
+    """ Saves every player's queue and state to the database, so they survive restarts.
+
+    Every SNAPSHOT_INTERVAL seconds the players are compared with what was saved last
+    and only the differences are written: the player row when the position, volume,
+    repeat flags or channels changed, and the songs the SongList logged as changed
+    (see SongList.take_changes()). An append writes just the new songs, a removal
+    deletes one row and renumbers the rows after it. A shuffle saves the songs in
+    their stored order along with the range still to be shuffled, so it does not
+    have to draw the whole shuffle. The rows are built on the database's writer thread.
+
+    On startup, restore() rebuilds the players from the saved songs. They were already
+    resolved, so this needs no YouTube or Spotify requests. It then rejoins the voice
+    channels and resumes where the songs left off.
+    """
+    def __init__(self, music, interval=SNAPSHOT_INTERVAL):
+        self.music = music
+        self.bot = music.bot
+        self.interval = interval
+        self.players = {} # key = guild_id, value = last saved player row
+        self.queues = {}  # key = guild_id, value = SongList last saved
+        self._task = self.bot.loop.create_task(self.run())
+
+    def _take(self):
+        """ Returns the snapshots that changed since the last call """
+        snapshots = []
+        players = self.music._music_players
+        for guild_id, player in players.items():
+            row = player_row(player)
+            if row is None:
+                if self.players.pop(guild_id, None) is not None:
+                    self.queues.pop(guild_id, None)
+                    snapshots.append((guild_id, None, None))
+                continue
+
+            songs = player.queue.songs
+            changes = songs.take_changes()
+            if self.queues.get(guild_id) is not songs or changes is None:
+                # A new or restored queue, or too many changes: save every song
+                change = ([(0, None, 0)], [(0, songs.stored())])
+            elif changes:
+                moves = [(start, end, count) for start, end, count in changes if count != end - start]
+                change = (moves, [(start, songs.stored(start, end)) for start, end in changed_ranges(changes)])
+            else:
+                change = None
+            if change is None and row == self.players.get(guild_id):
+                continue
+
+            snapshots.append((guild_id, row, change))
+            self.players[guild_id] = row
+            self.queues[guild_id] = songs
+
+        # Players that were removed
+        for guild_id in [guild_id for guild_id in self.players if guild_id not in players]:
+            del self.players[guild_id]
+            self.queues.pop(guild_id, None)
+            snapshots.append((guild_id, None, None))
+        return snapshots
+
+    async def flush(self):
+        snapshots = self._take()
+        if snapshots:
             try:
-                await self.queue_message.edit(embed=embed)
-            except discord.errors.NotFound:
-                pass
+                await self.bot.db.save_snapshots(snapshots)
+            except Exception:
+                # Only the changes were written, so forget what was saved and rewrite these guilds next time
+                for guild_id, _, _ in snapshots:
+                    self.players.pop(guild_id, None)
+                    self.queues.pop(guild_id, None)
+                raise
+
+    def flush_nowait(self):
+        """ Queues the changed snapshots on the database's writer thread (for shutdown) """
+        snapshots = self._take()
+        if snapshots:
+            self.bot.db.save_snapshots_nowait(snapshots)
+
+    def cancel(self):
+        self._task.cancel()
+
+    async def run(self):
+        """ Restores the saved players, then saves them every interval seconds """
+        await self.restore()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as error: # pylint: disable=broad-except
+                print(f"Failed to save queue snapshots: {error}")
+
+    async def restore(self):
+        """ Rebuilds the players saved before the last shutdown """
+        await self.bot.wait_until_ready()
+        try:
+            snapshots = await self.bot.db.load_snapshots()
+        except Exception as error: # pylint: disable=broad-except
+            print(f"Failed to load queue snapshots: {error}")
+            return
+        for row, songs in snapshots:
+            try:
+                await self.restore_player(row, songs)
+            except Exception as error: # pylint: disable=broad-except
+                print(f"Failed to restore the player of guild {row[0]}: {error}")
+
+    async def restore_player(self, row, song_rows):
+        (guild_id, voice_id, text_id, position, song_position, repeat, repeat_one, volume,
+         shuffle_from, shuffle_to) = row
+        guild = self.bot.get_guild(guild_id)
+        if guild is None:
+            return
+        player = await self.music.guild_player(guild)
+
+        users = player.queue.users
+        songs = []
+        for (_, _, title, duration, plays, query, spotify_id, youtube_id, thumbnail, url, user_id) in song_rows:
+            song = Song()
+            song.title = title
+            song.duration = duration
+            song.plays = plays
+            song.query = query
+            song.spotify_id = spotify_id
+            song.youtube_id = youtube_id
+            song.thumbnail = thumbnail
+            song.url = url
+            if user_id not in users:
+                users[user_id] = await find_member(guild, user_id)
+            song.user_id = user_id
+            songs.append(song)
+
+        player.queue.songs = SongList(songs)
+        if shuffle_from < shuffle_to:
+            player.queue.songs.shuffle(shuffle_from, shuffle_to)
+        player.queue.songs.take_changes()
+        player.queue.version += 1
+        player.queue.position = min(position, len(songs))
+        player.repeat = bool(repeat)
+        player.repeat_one = bool(repeat_one)
+        player.volume = volume
+        player.text_channel = guild.get_channel(text_id) if text_id else None
+        # Nothing to save until it changes
+        self.players[guild_id] = row
+        self.queues[guild_id] = player.queue.songs
+        print(f"[{guild.name}] Restored {len(songs)} songs")
+
+        # Rejoin the voice channel if somebody is still in it and pick up where we left off.
+        # Idle players are not prefetched (nor their songs pinned) until they play again.
+        voice_channel = guild.get_channel(voice_id) if voice_id else None
+        if voice_channel is None or player.text_channel is None or player.queue.next_song is None:
+            return
+        if not any(not member.bot for member in voice_channel.members):
+            return
+        player.queue.next_song.position = song_position or 0
+        await player.connect(voice_channel)
+        await player.play(player.text_channel)
 
 
 class MusicPlayer:
+    """ Plays a guild's song queue.
+
+    Playback is a small state machine: IDLE -> LOADING -> PLAYING <-> PAUSED -> IDLE.
+    The voice client's `after` callback moves it on to the next song the moment a
+    song ends, and `lock` keeps commands and reactions from interleaving. The lock is
+    not held while a song loads, see _play().
+
+    Songs play through a GaplessAudio: PRIME_SECONDS before a song ends, the next
+    one is opened and handed to it, so it starts on the very next frame.
+    """
+    IDLE = "idle"
+    LOADING = "loading"
+    PLAYING = "playing"
+    PAUSED = "paused"
+
     def __init__(self, bot, guild, volume=20):
         self.bot = bot
         self.guild = guild
-        self.volume = 20
+        self.volume = volume
         self.queue = SongQueue(bot)
         self.np_message = None     # (discord.Message) last printed Now Playing message
         self.volume_message = None # (discord.Message) last printed volume
-        self.play_lock = False
+        self.lock = asyncio.Lock()
+        self.state = self.IDLE
+        self.track = 0            # bumped whenever the song to play changes, see _play()
+        self.song = None          # (Song) the song in the voice client
+        self.source = None        # (GaplessAudio) the source in the voice client
+        self.next_up = None       # (Song) the song primed in self.source to play next
+        self.text_channel = None  # (discord.TextChannel) where the player was last started
         self.youtube = bot.get_cog('YouTube')
         self.vc = None
+        self.prefetcher = Prefetcher(self)
+        self.queue.listeners.append(self.prefetcher.refresh)
+        self.queue.listeners.append(self.check_next)
 
         self.repeat = False
         self.repeat_one = False
@@ -192,6 +523,7 @@ class MusicPlayer:
             # Repeat
             if self.repeat:
                 self.queue.position = 0
+        self.queue.changed()
 
     async def connect(self, voice_channel):
         """ Connects to a voice channel. Returns the voice channel or None if error """
@@ -223,170 +555,320 @@ class MusicPlayer:
         """ Plays through the song queue
         :param channel: discord.TextChannel to send now playing message
         """
-        # Allow one thread in here at a time
-        if self.play_lock:
-            return
-        self.play_lock = True
+        self.text_channel = text_channel
+        await self._play(text_channel)
+
+    async def _play(self, text_channel):
+        """ Starts the song at the queue position, unless one is already playing or loading.
+
+        The song is looked up and downloaded (or streamed) without holding the lock, so
+        skip, seek and stop stay responsive during a slow download. Whatever changes the
+        song to play bumps self.track, and a load finishing for an old track is dropped.
+        """
+        async with self.lock:
+            song = await self._song_to_load(text_channel)
+            if song is None:
+                return
+            self.track += 1
+            track = self.track
+            self.state = self.LOADING
+
+        # Grab the next song and get it ready (usually already done by the prefetcher)
+        error_message = None
+        skip_song = False # move past songs that fail to download
+        try:
+            song = await self.youtube.load_song(song)
+            # Get the mp3 ready, or start streaming it
+            audio_source_raw = await self.create_source(song)
+        except IndexError:
+            error_message = f"Something went wrong fetching song from queue (Error code: {len(self.queue.songs)} {self.queue.position})"
+        except QuotaExceeded:
+            error_message = f"Can't look up {song.title} on YouTube right now, the daily quota is used up. Songs played before still work."
+        except Exception as error:
+            error_message = f"Error downloading {song.title} {error}"
+            skip_song = True
+
+        async with self.lock:
+            # Skipped, stopped or disconnected while the song was loading
+            if track != self.track or self.vc is None:
+                if error_message is None:
+                    audio_source_raw.cleanup()
+                if track == self.track:
+                    self.state = self.IDLE
+                return
+            if error_message is not None:
+                await text_channel.send(error_message)
+                if skip_song:
+                    await self.increment_position()
+                self.state = self.IDLE
+                return
+            await self._start(song, audio_source_raw, text_channel)
 
+    async def _song_to_load(self, text_channel):
+        """ Returns the song _play() has to load, or None if there is nothing to load.
+        Resumes a paused player. Called with the lock held.
+        """
         # Require voice client to exist
         if self.vc is None: 
             await text_channel.send(f"Voice client does not exist. Please send stop command and try again.")
             print(f"Voice client does not exist: {self.vc}")
-            self.play_lock = False
-            return
-
-        ## Require voice client to be connected
-        #if not self.vc.is_connected(): 
-        #    await text_channel.send(f"Failed to join channel. Please send stop command and try again.")
-        #    await self.vc.disconnect(force=True)
-        #    self.vc = None
-        #    self.play_lock = False
-        #    return
+            self.state = self.IDLE
+            return None
 
-        # Do nothing if already playing
-        if self.vc.is_playing():
+        # Do nothing if already playing, or if the song is on its way
+        if self.state == self.PLAYING and self.vc.is_playing():
             print("Player already playing")
-            self.play_lock = False
-            return
+            return None
+        if self.state == self.LOADING:
+            return None
 
         # Change status text to "Now playing"
         if self.np_message is not None and self.np_message.embeds:
-            try:
-                embed = self.np_message.embeds[0]
-                title = "Now Playing ♫"
-                if not title == embed.title:
-                    embed.title = title
-                    await self.np_message.edit(embed=embed)
-            except discord.errors.NotFound:
-                pass
+            self.bot.edit_message(self.np_message, with_title("Now Playing ♫"))
 
         # Player was previously paused
         if self.vc.is_paused():
             self.vc.resume()
+            self.state = self.PLAYING
             print("Played was paused, resuming")
-            self.play_lock = False
-            return
+            return None
 
         # Delete now playing message if no song in queue
         if self.queue.next_song is None:
             print(f"[{text_channel.guild.name}] Nothing left in queue")
+            self.state = self.IDLE
             await self.queue.update_queue_message()
             await self.bot.delete_message(self.np_message)
             self.np_message = None
-            self.play_lock = False
-            return
-
-        # Grab the next song and get it ready
-        try:
-            song = self.queue.next_song
-            song = await self.youtube.load_song(song)
-        except IndexError:
-            await text_channel.send(f"Something went wrong fetching song from queue (Error code: {len(self.queue.songs)} {self.queue.position})")
-            self.play_lock = False
-            return
-        # Get the mp3 ready
-        try:
-            await self.download_song(song)
-        except Exception as error:
-            await text_channel.send(f"Error downloading {song.title} {error}")
-            await self.increment_position()
-            self.play_lock = False
-            return
+            return None
+        return self.queue.next_song
 
+    async def _start(self, song, audio_source_raw, text_channel):
+        """ Starts playing a loaded song. Called with the lock held. """
         # Log song info
-        print(f"[{text_channel.guild.name}] ({song.user.display_name}) playing {song.title} ({song.plays} plays)")
-
-        # Create the audio source. FFmpegPCMAudio reference:
-        # https://discordpy.readthedocs.io/en/latest/api.html#discord.FFmpegPCMAudio
-        options = f"-af loudnorm=I=-16.0:TP=-1.0 -ss {song.position}"
-        try:
-            audio_source_raw = discord.FFmpegPCMAudio(source=song.path, options=options)
-        except discord.errors.ClientException:
-            audio_source_raw = discord.FFmpegPCMAudio(source=song.path, executable="C:/ffmpeg/bin/ffmpeg.exe", options=options)
+        print(f"[{text_channel.guild.name}] ({self.requester(song).display_name}) playing {song.title} ({song.plays} plays)")
 
         # Set the volume. PCMVolumeTransformer reference:
         # https://discordpy.readthedocs.io/en/latest/api.html#discord.PCMVolumeTransformer
-        audio_source = discord.PCMVolumeTransformer(audio_source_raw, volume=self.volume / 100.0)
-
-        # Begin playback
-        self.vc.play(audio_source)
+        # Opus packets already have the volume baked in.
+        if audio_source_raw.is_opus():
+            audio_source = audio_source_raw
+        else:
+            audio_source = discord.PCMVolumeTransformer(audio_source_raw, volume=self.volume / 100.0)
+
+        # Begin playback and get the next songs ready. The callbacks come from the voice
+        # client's thread: `after` when the songs run out, is skipped or is stopped.
+        loop = self.bot.loop
+        gapless = GaplessAudio(audio_source,
+                               on_next=lambda: loop.call_soon_threadsafe(self.song_switched, gapless),
+                               on_prime=lambda: loop.call_soon_threadsafe(self.prime_next, gapless),
+                               prime_at=self.prime_frame(song),
+                               crossfade=int(CROSSFADE_SECONDS * 50))
+        self.song = song
+        self.source = gapless
+        self.next_up = None
+        # discord.py only creates the Opus encoder when the first source it plays is PCM,
+        # but the GaplessAudio can go from Opus packets to a PCM song later on
+        if self.vc.encoder is None:
+            self.vc.encoder = discord.opus.Encoder()
+        try:
+            self.vc.play(gapless, after=lambda error: loop.call_soon_threadsafe(self.song_ended, gapless, error))
+        except discord.errors.ClientException as error:
+            # Disconnected from voice
+            print(f"[{text_channel.guild.name}] Failed to play {song.title}: {error}")
+            gapless.cleanup()
+            self.source = None
+            self.state = self.IDLE
+            return
+        self.state = self.PLAYING
+        self.prefetcher.refresh()
         
         # Send now-playing message and update queue
         await self.send_now_playing(text_channel=text_channel)
         await self.queue.update_queue_message()
 
-        # Wait for it to finish
-        while self.vc and self.vc.is_playing():
-            await asyncio.sleep(2)
+    def song_ended(self, source, error):
+        """ Called on the event loop when the voice client is done with a source """
+        if error is not None:
+            print(f"[{self.guild.name}] Player error: {error!r}")
+        # Ignore sources that were skipped or stopped
+        if source is not self.source:
+            return
+        self.bot.loop.create_task(self.next(source))
+
+    async def next(self, source):
+        """ Counts the play of the song that ended and starts the next one """
+        async with self.lock:
+            if source is not self.source or self.vc is None:
+                return
+            self.source = None
+            self.state = self.IDLE
+            self.track += 1
+
+            # Song finished playing - increment playcount in database
+            self.song.plays += 1
+            self.song.position = 0
+            await self.bot.db.save_song(self.song)
+
+            # Go on to the next song
+            await self.increment_position()
+            # Update queue message
+            await self.queue.update_queue_message()
+        await self._play(self.text_channel)
+
+    def prime_frame(self, song):
+        """ Returns the frame of a song at which to prime the next one, None if unknown """
+        if song.duration is None:
+            return None
+        return max(0, int((song.duration - song.position - PRIME_SECONDS - CROSSFADE_SECONDS) * 50))
 
-        # Player was stopped or paused
-        if self.vc is None or self.vc.is_paused():
-            self.play_lock = False
+    def next_index(self):
+        """ Returns the queue index of the song after the current one, or None """
+        if self.repeat_one:
+            return self.queue.position
+        index = self.queue.position + 1
+        if index >= len(self.queue.songs):
+            if not self.repeat or not self.queue.songs:
+                return None
+            index = 0
+        return index
+
+    def prime_next(self, source):
+        """ Called on the event loop when the current song is about to end """
+        if source is self.source:
+            self.bot.loop.create_task(self.prepare_next(source))
+
+    async def prepare_next(self, gapless):
+        """ Opens the next song's audio and reads its first frame, then hands it to the
+        GaplessAudio so it starts on the frame after the current song's last.
+        """
+        index = self.next_index()
+        if gapless is not self.source or index is None:
+            return
+        song = self.queue.songs[index]
+        # Only songs on disk: a stream would have to wait for its download anyway
+        if song.youtube_id is None or not self.bot.audio_cache.contains(song.youtube_id):
             return
+        try:
+            # The play is counted when the song switches in, see switched()
+            source = await self.create_source(song, play=False)
+        except Exception as error: # pylint: disable=broad-except
+            print(f"Failed to prepare {song.title}: {error}")
+            return
+        if not source.is_opus():
+            source = discord.PCMVolumeTransformer(source, volume=self.volume / 100.0)
+        first_frame = await self.bot.loop.run_in_executor(None, source.read)
 
-        # Song finished playing - increment playcount in database
-        song.plays += 1
-        self.bot.db.save_song(song)
+        # The queue may have changed in the meantime
+        if gapless is not self.source or self.next_index() != index or self.queue.songs[index] is not song:
+            source.cleanup()
+            return
+        self.next_up = song
+        gapless.set_next(source, first_frame, self.prime_frame(song))
 
-        # Go on to the next song
-        await self.increment_position()
-        # Update queue message
-        await self.queue.update_queue_message()
-        self.play_lock = False
-        await self.play(text_channel)
+    def check_next(self):
+        """ Drops the primed song when a change to the queue means it is not next anymore """
+        if self.next_up is None:
+            return
+        index = self.next_index()
+        if index is None or self.queue.songs[index] is not self.next_up:
+            self.drop_next()
+
+    def drop_next(self):
+        """ Forgets the primed song and primes the song that is next now """
+        if self.source is not None and self.next_up is not None:
+            if not self.source.set_next(None):
+                # The voice thread already switched to it, switched() moves the queue on
+                return
+            self.next_up = None
+            self.bot.loop.create_task(self.prepare_next(self.source))
+
+    def song_switched(self, source):
+        """ Called on the event loop when the GaplessAudio went on to the primed song """
+        if source is self.source:
+            self.bot.loop.create_task(self.switched(source))
+
+    async def switched(self, source):
+        """ Counts the play of the song that ended and moves the queue on to the next one """
+        async with self.lock:
+            if source is not self.source or self.next_up is None:
+                return
+            self.song.plays += 1
+            self.song.position = 0
+            await self.bot.db.save_song(self.song)
+            self.song, self.next_up = self.next_up, None
+            self.bot.audio_cache.contains(self.song.youtube_id, play=True)
+
+            await self.increment_position()
+            print(f"[{self.guild.name}] ({self.requester(self.song).display_name}) playing {self.song.title} ({self.song.plays} plays)")
+            await self.send_now_playing(text_channel=self.text_channel)
+            await self.queue.update_queue_message()
 
     async def pause(self):
         """ Pauses voice client and updates the Now Playing message """
         if self.vc is not None and self.vc.is_playing():
             self.vc.pause()
+            self.state = self.PAUSED
         if self.np_message and self.np_message.embeds:
-            try:
-                embed = self.np_message.embeds[0]
-                title = "Now Paused ♫"
-                if not title == embed.title:
-                    embed.title = title
-                    await self.np_message.edit(embed=embed)
-            except discord.errors.NotFound:
-                pass
+            self.bot.edit_message(self.np_message, with_title("Now Paused ♫"))
 
     async def set_volume(self, volume):
-        """ Sets the player's volume in range [0,100] """
+        """ Sets the player's volume in range [0,100] and saves it for the guild """
         self.volume = max(min(100, volume), 0)
 
         # Change current audio source volume
-        if self.vc and self.vc.source:
-            self.vc.source.volume = self.volume/100.0
-
+        gapless = self.source
+        if gapless is not None:
+            if isinstance(gapless.next, discord.PCMVolumeTransformer):
+                gapless.next.volume = self.volume/100.0
+            elif isinstance(gapless.next, PacketAudio) and self.volume != PACKET_VOLUME:
+                self.drop_next()
+            if isinstance(gapless.source, discord.PCMVolumeTransformer):
+                gapless.source.volume = self.volume/100.0
+            elif isinstance(gapless.source, PacketAudio) and self.volume != PACKET_VOLUME:
+                await self.leave_packets(gapless.source)
+
+        await self.bot.db.set_guild_setting(self.guild.id, "volume", self.volume)
         return self.volume
 
     async def skip(self, n=1):
         """ Skips n songs """
         print(f"skipping {n} songs")
-        index = self.queue.position + n
-        # Something is playing, it will increment pos by 1 when we stop the queue
-        if self.vc and self.vc.is_playing():
-            index = max(0, index - 1)
-            self.queue.position = min(index, len(self.queue.songs))
-            self.vc.stop()
-        else:
-            self.queue.position = min(index, len(self.queue.songs))
-        print("skipped to:", self.queue.position)
+        await self.skipto(self.queue.position + n)
 
     async def skipto(self, index):
         """ Skips to the given index """
         print("skipping to ", index, min(index, len(self.queue.songs)))
-        # Something is playing, it will increment pos by 1 when we stop the queue
-        if self.vc and self.vc.is_playing():
-            index = max(0, index - 1)
-            self.queue.position = min(index, len(self.queue.songs))
-            self.vc.stop()
-        else:
+        async with self.lock:
             self.queue.position = min(index, len(self.queue.songs))
+            if self.repeat and self.queue.position == len(self.queue.songs):
+                self.queue.position = 0
+            self.queue.changed()
+
+            # Stop the current (or loading) song without counting a play, and start the new one
+            restart = self.state == self.LOADING or \
+                      (self.vc is not None and (self.vc.is_playing() or self.vc.is_paused()))
+            if restart:
+                self.source = None
+                if self.song is not None:
+                    self.song.position = 0
+                self.state = self.IDLE
+                self.track += 1
+                if self.vc is not None:
+                    self.vc.stop()
+        if restart:
+            await self._play(self.text_channel)
         print("skipped to:", self.queue.position)
 
     async def stop(self):
         """ Clears queue and disconnects, deleting all messages """
         await self.queue.clear()
+        self.prefetcher.cancel()
+        self.source = None
+        self.state = self.IDLE
+        self.track += 1 # drops a song that is still loading
+        if self.song is not None:
+            self.song.position = 0
         if self.vc is not None:
             await self.vc.disconnect(force=True)
             self.vc = None
@@ -395,23 +877,145 @@ class MusicPlayer:
         self.np_message = None
         self.queue_message = None
 
-    async def download_song(self, song):
-        """ Downloads the .mp3 file from YouTube """
-        if not os.path.exists("./songs"):
-            os.mkdir("./songs")
+    async def create_source(self, song, play=True):
+        """ Returns an audio source for the song.
+
+        Cached songs are played from their Opus packet store when the player is at
+        PACKET_VOLUME, or through FFmpeg from disk. Otherwise the download is started
+        right away and, if STREAMING is on, the song is played while it downloads.
+
+        Args:
+            play: False when the song is only primed, so the cache does not count a play yet.
+        """
+        cache = self.bot.audio_cache
+        downloads = self.youtube.downloads
+
+        gain = await self.bot.db.get_gain(song.youtube_id)
+        options = audio_filter(gain)
+
+        # Pre-encoded Opus packets need no FFmpeg, but only come at PACKET_VOLUME
+        cached = cache.contains(song.youtube_id, play=play)
+        if cached and gain is not None and self.volume == PACKET_VOLUME:
+            try:
+                return PacketAudio(packet_path(song.youtube_id), song.position)
+            except (OSError, ValueError):
+                pass # not encoded yet
+
+        if STREAMING and not cached:
+            job = downloads.start(song.youtube_id, song.path, downloads.NOW_PLAYING)
+
+            async def download():
+                await downloads.download(song.youtube_id, song.path, downloads.NOW_PLAYING)
+                await cache.add(song.youtube_id)
+            task = asyncio.ensure_future(download())
+
+            # Wait until FFmpeg has enough of the file to start
+            while not task.done() and file_size(job.temp_path) < STREAM_START_BYTES:
+                await asyncio.sleep(0.05)
+
+            if not task.done():
+                try:
+                    try:
+                        source = StreamingAudio(job.temp_path, job.finished, options=options)
+                    except discord.errors.ClientException:
+                        source = StreamingAudio(job.temp_path, job.finished, executable="C:/ffmpeg/bin/ffmpeg.exe", options=options)
+                except FileNotFoundError:
+                    # The download finished in the meantime, play the finished file
+                    source = None
+                if source is not None:
+                    print(f"Streaming {song.title} while it downloads")
+                    song.position = 0 # streams can't seek
+                    task.add_done_callback(log_stream_error)
+                    return source
+            await task # raises if the download failed
+        elif not cached:
+            await self.download_song(song)
+        elif gain is None or not os.path.isfile(packet_path(song.youtube_id)):
+            # Downloaded before it could be measured and encoded
+            cache.analyze(song.youtube_id)
+
+        return self.file_source(song, options, song.position)
+
+    def file_source(self, song, options, position=0):
+        """ Returns an FFmpegPCMAudio playing a downloaded song from `position` seconds """
+        # Create the audio source. FFmpegPCMAudio reference:
+        # https://discordpy.readthedocs.io/en/latest/api.html#discord.FFmpegPCMAudio
+        # -ss before the input seeks in the file instead of decoding up to the position
+        before_options = f"-ss {position}"
+        try:
+            return discord.FFmpegPCMAudio(source=song.path, before_options=before_options, options=options)
+        except discord.errors.ClientException:
+            return discord.FFmpegPCMAudio(source=song.path, executable="C:/ffmpeg/bin/ffmpeg.exe",
+                                          before_options=before_options, options=options)
+
+    async def leave_packets(self, source):
+        """ Switches the playing song from its Opus packets to FFmpeg at the same position,
+        since the volume of Opus packets can't be changed.
+        """
+        song = self.song
+        gain = await self.bot.db.get_gain(song.youtube_id)
+        song.position = self.position
+        raw = self.file_source(song, audio_filter(gain), song.position)
+        self.source.replace(discord.PCMVolumeTransformer(raw, volume=self.volume / 100.0), self.prime_frame(song))
+
+    def requester(self, song):
+        """ Returns the member who queued a song, or the bot itself if they are unknown """
+        return self.queue.users.get(song.user_id) or self.guild.get_member(song.user_id) or self.guild.me
+
+    @property
+    def position(self):
+        """ Seconds into the current song, counted from the frames sent to the voice client """
+        if self.song is None or self.source is None:
+            return 0
+        return self.song.position + self.source.frames / 50
+
+    async def seek(self, position):
+        """ Jumps to `position` seconds into the current song.
+
+        Cached songs are reopened at the position: Opus packet stores through their frame
+        index, mp3 files with FFmpeg's input seeking. Songs that are still streaming can't
+        seek.
+
+        Returns:
+            The new position in seconds, or None if the current song can't seek.
+        """
+        async with self.lock:
+            song, gapless = self.song, self.source
+            if gapless is None or not self.bot.audio_cache.contains(song.youtube_id):
+                return None
+            position = max(0, position)
+            if song.duration is not None:
+                position = min(position, song.duration)
+
+            if isinstance(gapless.source, PacketAudio):
+                source = PacketAudio(packet_path(song.youtube_id), position)
+            else:
+                gain = await self.bot.db.get_gain(song.youtube_id)
+                raw = self.file_source(song, audio_filter(gain), position)
+                source = discord.PCMVolumeTransformer(raw, volume=self.volume / 100.0)
+            song.position = position
+            gapless.replace(source, self.prime_frame(song))
+            return position
+
+    async def download_song(self, song, priority=None):
+        """ Downloads the .mp3 file from YouTube on the download pool.
+
+        Args:
+            priority: One of the DownloadPool priorities, defaults to NOW_PLAYING.
+        """
+        downloads = self.youtube.downloads
+        if priority is None:
+            priority = downloads.NOW_PLAYING
 
         # Use cached file if it exists
-        if os.path.isfile(song.path):
+        cache = self.bot.audio_cache
+        # create_source() already counted the play
+        if cache.contains(song.youtube_id):
             print(f"Using cached file for {song.title}: {song.path}")
             return
-    
-        # Download using youtube-dl
-        self.youtube.downloader.download(['https://www.youtube.com/watch?v=BaW_jenozKc'])
-        download = self.youtube.downloader.download([f"http://youtube.com/watch?v={song.youtube_id}"])
 
-        # Rename to song_id.mp3
-        if os.path.isfile(song.youtube_id):
-            os.rename(song.youtube_id, song.path)
+        await downloads.download(song.youtube_id, song.path, priority)
+        await cache.add(song.youtube_id)
         
     async def send_now_playing(self, text_channel):
         """ Sends a Now Playing message, if possible also deletes the last one """
@@ -428,7 +1032,8 @@ class MusicPlayer:
         text = f"[**{song.title}**]({song.url})"
 
         # Add user's name and song duration to footer
-        footer = f"@{song.user.display_name} ({song.pretty_duration})"
+        user = self.requester(song)
+        footer = f"@{user.display_name} ({song.pretty_duration})"
 
         # Add "Up next" to footer if something is in the queue
         if len(self.queue.songs) > self.queue.position + 1:
@@ -438,7 +1043,7 @@ class MusicPlayer:
         self.np_message = await self.bot.send_embed(channel=text_channel,
                                                     color=0xFF69B4,
                                                     footer=footer,
-                                                    footer_icon=song.user.avatar_url_as(size=64),
+                                                    footer_icon=user.avatar_url_as(size=64),
                                                     text=text,
                                                     thumbnail=song.thumbnail,
                                                     title="Now Playing ♫")
@@ -462,41 +1067,45 @@ class MusicPlayer:
 
     async def update_volume_message(self, user):
         """ Updates the last sent volume message """
-        if self.volume_message is not None:
-            embed = self.volume_message.embeds[0]
-            embed.title = f"Current volume : {int(self.volume)}%"
-            embed.description = volume_bar(self.volume)
-            embed.set_footer(text=f"Changed by {user.display_name}", 
-                             icon_url=user.avatar_url_as(size=64))
-            try:
-                await self.volume_message.edit(embed=embed)
-            except discord.errors.NotFound:
-                pass
+        if self.volume_message is not None and self.volume_message.embeds:
+            def render(embed):
+                embed.title = f"Current volume : {int(self.volume)}%"
+                embed.description = volume_bar(self.volume)
+                embed.set_footer(text=f"Changed by {user.display_name}",
+                                 icon_url=user.avatar_url_as(size=64))
+                return embed
+            self.bot.edit_message(self.volume_message, render)
 
 
 class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self._music_players = {} # key = guild.id, value = music.MusicPlayer()
-        self.genius = lyricsgenius.Genius(keys.genius_key)
-        self.genius.verbose = False # Turn off status messages
         self.youtube = self.bot.get_cog('YouTube')
         self.spotify = self.bot.get_cog('Spotify')
+        self.snapshots = QueueSnapshots(self)
 
-    async def args_to_songs(self, args):
-        """ Converts a list of arguments to a list of Songs """
-        songs = []
+    def cog_unload(self):
+        self.snapshots.cancel()
+        self.snapshots.flush_nowait()
+
+    async def resolve_songs(self, args):
+        """ Converts a list of arguments to Songs, yielding them in batches as they resolve.
+
+        Playlists and albums come one page at a time, so the first songs can play
+        before the rest of a big playlist has been fetched.
+        """
         query = ""
 
         for arg in args:
             # Spotify songs/playlists/albums
             if 'spotify.com' in arg:
-                spotify_songs = await self.spotify.url_to_songs(arg)
-                songs.extend(spotify_songs)
+                async for songs in self.spotify.iter_url_songs(arg):
+                    yield songs
             # YouTube videos/playlists
             elif 'youtube.com' in arg or 'youtu.be' in arg:
-                youtube_songs = await self.youtube.url_to_songs(arg)
-                songs.extend(youtube_songs)
+                async for songs in self.youtube.iter_url_songs(arg):
+                    yield songs
             # Gather all non-links into one query string
             else:
                 query = query + arg + " "
@@ -505,44 +1114,124 @@ class Music(commands.Cog):
                 
         # Search query
         if len(query) > 0:
-            result = self.bot.db.find_song(query=query)
+            result = await self.bot.db.find_song(query=query)
             if result is None: 
                 song = Song()
                 song.query = query
                 try:
                     song = await self.youtube.load_song(song)
-                    songs.append(song)
+                    yield [song]
                 except IndexError:
                     pass
             else:
-                songs.append(result)
+                yield [result]
 
-        return songs
+    async def queue_args(self, ctx, music_channel, voice_channel, player, args, insert=False):
+        """ Queues the songs of a play command as they resolve, see resolve_songs().
+
+        Playback starts with the first batch. Imports that take longer than
+        STATUS_INTERVAL get a "queued N songs so far" message, which is kept up to
+        date through bot.edit_message() (at most one edit every EDIT_INTERVAL seconds).
+
+        Args:
+            voice_channel: The channel to play in. The author may leave it while the
+                           songs resolve, so ctx.author.voice is not read again.
+        Returns:
+            The queued songs.
+        """
+        up_next = " up next" if insert else ""
+        queued = []
+        index = None
+        songs = player.queue.songs
+        status = None # the "queued N songs so far" message
+        start_time = time.perf_counter()
+        try:
+            async for batch in self.resolve_songs(args):
+                # The queue was cleared or the player stopped, drop the rest
+                if player.queue.songs is not songs:
+                    break
+                if not batch:
+                    continue
+
+                # Later batches of a playnext go behind the earlier ones
+                end = await player.queue.queue(batch, user=ctx.author, insert=insert, index=index)
+                if insert:
+                    index = end
+                queued.extend(batch)
+
+                # Start playing with the first songs, or again if they all played already
+                if player.state == MusicPlayer.IDLE:
+                    await player.connect(voice_channel=voice_channel)
+                    await player.play(text_channel=music_channel)
+
+                text = f"Queued {len(queued)} songs{up_next} so far..."
+                if status is not None:
+                    self.bot.edit_message(status, with_description(text))
+                elif time.perf_counter() - start_time >= STATUS_INTERVAL:
+                    status = await music_channel.send(embed=discord.Embed(description=text))
+        except QuotaExceeded:
+            # Keep what was queued so far
+            await music_channel.send("YouTube's daily quota is used up, only songs played before can be queued right now.")
+
+        if not queued:
+            return queued
+
+        # Response based on number of songs queued
+        if len(queued) == 1:
+            response = f"Queued [{queued[0].title}]({queued[0].url}){up_next}"
+        else:
+            response = f"Queued {len(queued)} songs{up_next}"
+        if status is None:
+            await music_channel.send(embed=discord.Embed(description=response))
+        else:
+            self.bot.edit_message(status, with_description(response))
+        return queued
+
+    async def search_lyrics(self, query):
+        """ Searches Genius for a song and scrapes its lyrics.
+
+        Returns:
+            A tuple of (Genius song dict, lyrics string), or None if nothing was found.
+        """
+        results = await self.bot.web.get_json("https://api.genius.com/search", params={"q": query},
+                                              headers={"Authorization": f"Bearer {keys.genius_key}"})
+        hits = [hit for hit in results.get("response", {}).get("hits", []) if hit.get("type") == "song"]
+        if not hits:
+            return None
+
+        # The API does not return lyrics, they have to be scraped from the song page
+        result = hits[0]["result"]
+        page = await self.bot.web.get_text(result["url"])
+        lyrics = await self.bot.loop.run_in_executor(None, parse_lyrics, page)
+        if not lyrics:
+            return None
+        return result, lyrics
 
     async def get_player(self, ctx):
         """ Finds or creates a guild's music player. """
+        return await self.guild_player(ctx.guild)
+
+    async def guild_player(self, guild):
+        """ Finds or creates the music player of a guild. """
         try:
-            player = self._music_players[ctx.guild.id]
+            player = self._music_players[guild.id]
         except KeyError:
-            # Create new MusicPlayer, check database for saved volume
-            self.bot.db.cursor.execute(f"SELECT volume FROM guilds WHERE id = ?", (ctx.guild.id,))
-            vol = self.bot.db.cursor.fetchone()
-            volume = 20
-            if vol is not None and vol[0] is not None:
-                volume = vol[0]
-            self._music_players[ctx.guild.id] = MusicPlayer(self.bot, ctx.guild, volume)
-            player = self._music_players[ctx.guild.id]
+            # Create new MusicPlayer with the guild's saved volume
+            volume = await self.bot.db.get_guild_setting(guild.id, "volume")
+            if volume is None:
+                volume = 20
+            self._music_players[guild.id] = MusicPlayer(self.bot, guild, volume)
+            player = self._music_players[guild.id]
         return player
 
     async def find_music_channel(self, ctx):
         """ Returns the guild's music channel if it exists """
-        # Check the database
-        self.bot.db.cursor.execute(f"SELECT music_channel FROM guilds WHERE id = ?", (ctx.guild.id,))
-        result = self.bot.db.cursor.fetchone()
+        # Check the guild's settings
+        result = await self.bot.db.get_guild_setting(ctx.guild.id, "music_channel")
         print("find music channel:", result)
-        if result and result[0] is not None:
-            print("found id:", result[0])
-            music_channel = self.bot.get_channel(int(result[0]))
+        if result is not None:
+            print("found id:", result)
+            music_channel = self.bot.get_channel(int(result))
             print("found music_channel:", music_channel)
             
             # Delete the message and mention the music channel if it doesn't match
@@ -571,6 +1260,11 @@ class Music(commands.Cog):
             await player.queue.clear()
             await ctx.send(f"{ctx.author.display_name} cleared the queue")
 
+    @commands.command(aliases=["ff", "fastforward"])
+    async def forward(self, ctx, *args):
+        """ Skips ahead in the current song, 10 seconds by default """
+        await self.seek_by(ctx, args, 1)
+
     @commands.command()
     async def lyrics(self, ctx, *args):
         """ Gets lyrics from Genius """
@@ -588,24 +1282,25 @@ class Music(commands.Cog):
             else:
                 query = " ".join(args)
 
-            song = self.genius.search_song(query)
-            if song is None:
+            found = await self.search_lyrics(query)
+            if found is None:
                 await ctx.send(f"Failed to find lyrics for '{query}'")
                 return
+            song, lyrics = found
             
             # Cut the lyrics off at 4 messages
-            text = song.lyrics[:8000]
-            text += f"\n\n[Click here to see the full lyrics on Genius]({song.url})"
+            text = lyrics[:8000]
+            text += f"\n\n[Click here to see the full lyrics on Genius]({song['url']})"
             elapsed = round(time.perf_counter() - start_time, 2)
             footer = f"Lyrics found in {elapsed} seconds"
             if elapsed < 0.1:
                 footer += " (cached!)"
             await self.bot.send_embed(channel=ctx,
-                                      title=song.title,
+                                      title=song.get("title"),
                                       text=text,
                                       footer=footer,
                                       color=0xffff64,
-                                      thumbnail=song._body.get("song_art_image_thumbnail_url"))
+                                      thumbnail=song.get("song_art_image_thumbnail_url"))
 
     @commands.command(aliases=["np"])
     async def nowplaying(self, ctx):
@@ -634,35 +1329,25 @@ class Music(commands.Cog):
             response = f"{ctx.author.mention} you must be in a voice channel to play music."
             await self.bot.send_embed(channel=music_channel, text=response, thumbnail="http://i.imgur.com/go67eLE.gif")
             return
+        voice_channel = ctx.author.voice.channel
 
         print("play", args, ctx)
 
         # Get the music player for this guild
         player = await self.get_player(ctx)
 
-        # Iterate through each argument and figure out what the user wants
+        # Queue the songs as they resolve, playback starts with the first one
         if len(args) > 0:
             async with music_channel.typing():
-                songs = await self.args_to_songs(args)
+                songs = await self.queue_args(ctx, music_channel, voice_channel, player, args)
 
                 # No results from search
                 if len(songs) == 0:
                     await ctx.send(f"Could not find song from query: '{' '.join(args)}'")
                     return
-
-                # Response based on number of songs queued
-                if len(songs) == 1:
-                    response = f"Queued [{songs[0].title}]({songs[0].url})"
-                else:
-                    response = f"Queued {len(songs)} songs"
-
-                # Add the songs to the queue
-                await player.queue.queue(songs, user=ctx.author)
-                embed = discord.Embed(description=response)
-                await music_channel.send(embed=embed)
         
         # Begin playback
-        await player.connect(voice_channel=ctx.author.voice.channel)
+        await player.connect(voice_channel=voice_channel)
         await player.play(text_channel=music_channel)
 
     @commands.command(aliases=["pnext", "upnext"])
@@ -675,6 +1360,7 @@ class Music(commands.Cog):
             response = f"{ctx.author.mention} you must be in a voice channel to play music."
             await self.bot.send_embed(channel=music_channel, text=response, thumbnail="http://i.imgur.com/go67eLE.gif")
             return
+        voice_channel = ctx.author.voice.channel
 
         # Require arguments
         if len(args) == 0:
@@ -684,28 +1370,17 @@ class Music(commands.Cog):
         # Get the music player for this guild
         player = await self.get_player(ctx)
 
-        # Iterate through each argument and figure out what the user wants
+        # Queue the songs as they resolve, playback starts with the first one
         async with music_channel.typing():
-            songs = await self.args_to_songs(args)
+            songs = await self.queue_args(ctx, music_channel, voice_channel, player, args, insert=True)
 
             # No results from search
             if len(songs) == 0:
                 await music_channel.send(f"Could not find song from query: '{' '.join(args)}'")
                 return
-
-            # Response based on number of songs queued
-            if len(songs) == 1:
-                response = f"Queued [{songs[0].title}]({songs[0].url}) up next"
-            else:
-                response = f"Queued {len(songs)} songs up next"
-
-            # Add the songs to the queue
-            await player.queue.queue(songs, user=ctx.author, insert=True)
-            embed = discord.Embed(description=response)
-            await music_channel.send(embed=embed)
         
         # Begin playback
-        await player.connect(voice_channel=ctx.author.voice.channel)
+        await player.connect(voice_channel=voice_channel)
         await player.play(text_channel=music_channel)
 
     @commands.command(aliases=["palbum"])
@@ -804,15 +1479,12 @@ class Music(commands.Cog):
         print(type(self._music_players))
         for guild_id, player in self._music_players.items():
             # If the player exists, add to appropriate list
-            if player.vc is None:
+            if player.vc is None or player.state == player.IDLE:
                 stopped.append(player)
+            elif player.state == player.PAUSED:
+                paused.append(player)
             else:
-                if player.vc.is_playing():
-                    playing.append(player)
-                elif player.vc.is_paused():
-                    paused.append(player)
-                else:
-                    stopped.append(player)
+                playing.append(player)
 
         title = "Music Player Stats"
         text = f"Playing: {len(playing)}\n"
@@ -846,10 +1518,9 @@ class Music(commands.Cog):
 
             player = await self.get_player(ctx)
             try:
-                song = player.queue.songs.pop(index)
+                song = await player.queue.remove(index)
                 response = "Removed: **{}** [{}]({})".format(index, song.title, song.url)
                 await self.bot.send_embed(channel=ctx, text=response)
-                await player.queue.update_queue_message()
             except IndexError:
                 await ctx.send("Failed to remove song at index {}".format(index))
 
@@ -918,6 +1589,46 @@ class Music(commands.Cog):
         await player.connect(ctx.author.voice.channel)
         await player.play(text_channel=music_channel)
 
+    @commands.command(aliases=["rw"])
+    async def rewind(self, ctx, *args):
+        """ Goes back in the current song, 10 seconds by default """
+        await self.seek_by(ctx, args, -1)
+
+    @commands.command()
+    async def seek(self, ctx, *args):
+        """ Jumps to a time in the current song, e.g. 1:30 """
+        position = parse_time(args[0]) if args else None
+        if position is None:
+            await ctx.send(f"Usage: {ctx.prefix}{ctx.invoked_with} [time, e.g. 90 or 1:30]")
+            return
+        await self.seek_to(ctx, position)
+
+    async def seek_by(self, ctx, args, direction):
+        """ Moves the current song forward (direction=1) or back (direction=-1) """
+        seconds = parse_time(args[0]) if args else 10
+        if seconds is None:
+            await ctx.send(f"Usage: {ctx.prefix}{ctx.invoked_with} [seconds, e.g. 30 or 1:30]")
+            return
+        player = await self.get_player(ctx)
+        await self.seek_to(ctx, player.position + direction * seconds)
+
+    async def seek_to(self, ctx, position):
+        if not author_voice_connected(ctx):
+            response = f"{ctx.author.display_name}, you must be in a voice channel to seek."
+            await self.bot.send_embed(channel=ctx, text=response, thumbnail="http://i.imgur.com/go67eLE.gif")
+            return
+
+        player = await self.get_player(ctx)
+        if player.song is None or player.source is None:
+            await ctx.send("Nothing is playing.")
+            return
+
+        position = await player.seek(position)
+        if position is None:
+            await ctx.send(f"Can't seek in {player.song.title} until it has finished downloading.")
+            return
+        await ctx.send(f"Jumped to {pretty_time(position)} in {player.song.title}")
+
     @commands.command()
     async def shuffle(self, ctx):
         """ Shuffles the queue """
@@ -1109,6 +1820,96 @@ def author_voice_connected(ctx):
     except AttributeError:
         return False
 
+def log_stream_error(task):
+    """ Prints the error of a failed streaming download (the song plays what was downloaded) """
+    if not task.cancelled() and task.exception() is not None:
+        print(f"Streaming download failed: {task.exception()}")
+
+def file_size(path):
+    """ Returns the size of a file in bytes, or 0 if it does not exist """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def parse_lyrics(page):
+    """ Extracts the lyrics from the HTML of a Genius song page """
+    soup = BeautifulSoup(page, "html.parser")
+    containers = soup.select("div[data-lyrics-container]")
+    if not containers:
+        # older page layout
+        containers = soup.select("div.lyrics")
+    lyrics = "\n".join(container.get_text(separator="\n") for container in containers)
+    return lyrics.strip()
+
+async def find_member(guild, user_id):
+    """ Returns the guild's member with this id, or the bot itself if they left """
+    member = guild.get_member(user_id) if user_id else None
+    if member is None and user_id:
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.errors.HTTPException:
+            pass
+    return member or guild.me
+
+def player_row(player):
+    """ Returns a player's row of PLAYER_COLUMNS, or None if it is stopped with an empty queue """
+    if player.vc is None and not player.queue.songs:
+        return None
+    voice_channel = player.vc.channel.id if player.vc is not None and player.vc.channel else None
+    text_channel = player.text_channel.id if player.text_channel is not None else None
+    return (player.guild.id, voice_channel, text_channel, player.queue.position, int(player.position),
+            int(player.repeat), int(player.repeat_one), player.volume, *player.queue.songs.pending_shuffle())
+
+def display_title(song):
+    """ Returns a song's title without brackets, which would break the queue message's links """
+    title = song.title or song.query or "?"
+    cleaned = title.translate(DISPLAY_TITLE_TABLE)
+    # Share the title string when there was nothing to remove
+    return title if cleaned == title else cleaned
+
+def with_title(title):
+    """ Returns a MessageEditor render function that sets an embed's title """
+    def render(embed):
+        embed.title = title
+        return embed
+    return render
+
+def with_description(text):
+    """ Returns a MessageEditor render function that sets an embed's description """
+    def render(embed):
+        embed.description = text
+        return embed
+    return render
+
+def audio_filter(gain):
+    """ Returns the FFmpeg options that normalize a song's loudness.
+
+    Args:
+        gain: The song's measured gain in dB, or None to normalize it on the fly.
+    """
+    if gain is None:
+        return f"-af {LOUDNORM_FILTER}"
+    return f"-af volume={gain}dB"
+
+def parse_time(text):
+    """ Converts a time like '90', '1:30' or '1:02:03' into seconds, None if it isn't one """
+    seconds = 0
+    try:
+        for part in text.split(":"):
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return None
+    return seconds
+
+def pretty_time(seconds):
+    """ Converts seconds into a time like '1:30' or '1:02:03' """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
+
 def volume_bar(volume):
     """ Returns an ASCII volume bar  """
     text = ""
@@ -0,0 +1,152 @@
+""" YouTube Data API quota budget, shared by every request of the YouTube cog """
+import collections
+import datetime
+import hashlib
+import time
+
+try:
+    import zoneinfo
+except ImportError: # Python 3.8
+    from backports import zoneinfo
+
+
+DAILY_QUOTA = 10000      # units each API key may spend per day
+QUOTA_RESERVE = 500      # units per key kept for the cheap endpoints, searches stop short of it
+ENDPOINT_COSTS = {       # units per request, from the API's quota calculator
+    "search": 100,
+    "videos": 1,
+    "playlistItems": 1,
+}
+DEFAULT_COST = 1
+DAY = 24 * 60 * 60       # seconds
+BURN_WINDOW = 60 * 60    # seconds of usage used for the burn rate
+QUOTA_TIMEZONE = zoneinfo.ZoneInfo("America/Los_Angeles") # quotas reset at midnight Pacific
+
+
+class QuotaExceeded(Exception):
+    """ Raised when no API key has enough quota left for a request """
+
+
+def quota_day(now):
+    """ Returns the Pacific calendar day (e.g. "2021-03-14") that a time.time() falls on """
+    return datetime.datetime.fromtimestamp(now, QUOTA_TIMEZONE).date().isoformat()
+
+def key_id(key):
+    """ Returns the id an API key's usage is saved under, so the key itself is not stored """
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def save_usage(connection, rows):
+    connection.executemany("INSERT OR REPLACE INTO youtube_quota VALUES (?,?,?,?)", rows)
+
+
+class QuotaManager:
+    """ Tracks the units spent by each YouTube API key today.
+
+    Google resets the quotas at midnight Pacific time, so usage is counted per
+    Pacific calendar day (daylight saving included) and starts over when it changes.
+    take() picks the key with the most units left for a request and records its cost.
+    Searches (100 units) are refused once they would dip into a key's QUOTA_RESERVE,
+    so near the limit only cached searches work while playlists and video details
+    (1 unit) keep going. A key the API reports as over quota is skipped for the rest
+    of the day.
+
+    The YouTube cog saves the usage in the database (see rows() and restore()), so a
+    restart does not start the count over.
+
+    Args:
+        keys: The API keys, in order of preference.
+    """
+    def __init__(self, keys, daily_quota=DAILY_QUOTA, reserve=QUOTA_RESERVE):
+        self.keys = list(keys)
+        self.daily_quota = daily_quota
+        self.reserve = reserve
+        self.day = quota_day(time.time())
+        self.usage = {key: 0 for key in self.keys} # units spent today
+        self.exhausted = set()                     # keys the API refuses until the day ends
+        self.events = collections.deque()          # (time, key, endpoint, cost) of the last DAY, for the stats
+        self.refused = 0 # requests refused for lack of quota
+        self.dirty = False # usage changed since the last rows()
+
+    def _update(self, now):
+        """ Starts a new count when the day changed and drops the events older than DAY """
+        day = quota_day(now)
+        if day != self.day:
+            self.day = day
+            self.usage = {key: 0 for key in self.keys}
+            self.exhausted = set()
+            self.dirty = True
+        while self.events and self.events[0][0] <= now - DAY:
+            self.events.popleft()
+
+    def remaining(self, key, now=None):
+        """ Returns the units a key has left today """
+        now = time.time() if now is None else now
+        self._update(now)
+        if key in self.exhausted:
+            return 0
+        return max(0, self.daily_quota - self.usage[key])
+
+    def take(self, endpoint):
+        """ Returns the key to use for a request and records its cost.
+
+        Raises:
+            QuotaExceeded: If no key can afford the request.
+        """
+        now = time.time()
+        cost = ENDPOINT_COSTS.get(endpoint, DEFAULT_COST)
+        # Only the expensive endpoints have to leave the reserve alone
+        needed = cost + self.reserve if cost > DEFAULT_COST else cost
+        key = max(self.keys, key=lambda key: self.remaining(key, now), default=None)
+        if key is None or self.remaining(key, now) < needed:
+            self.refused += 1
+            raise QuotaExceeded(f"YouTube quota exhausted, {endpoint} requests are paused")
+        self.usage[key] += cost
+        self.events.append((now, key, endpoint, cost))
+        self.dirty = True
+        return key
+
+    def exhaust(self, key):
+        """ Stops using a key until its quota resets at midnight Pacific """
+        self._update(time.time())
+        self.exhausted.add(key)
+        self.dirty = True
+        print(f"YouTube key ...{key[-4:]} is out of quota")
+
+    def rows(self):
+        """ Returns the rows of the youtube_quota table: (key id, day, units, exhausted) """
+        self._update(time.time())
+        self.dirty = False
+        return [(key_id(key), self.day, self.usage[key], int(key in self.exhausted)) for key in self.keys]
+
+    def restore(self, rows):
+        """ Adds the usage saved before a restart, see rows(). Rows of other days are ignored. """
+        self._update(time.time())
+        keys = {key_id(key): key for key in self.keys}
+        for saved_id, day, units, exhausted in rows:
+            key = keys.get(saved_id)
+            if key is None or day != self.day:
+                continue
+            self.usage[key] += units
+            if exhausted:
+                self.exhausted.add(key)
+            self.dirty = True
+
+    def burn_rate(self):
+        """ Returns the units spent per hour over the last BURN_WINDOW seconds """
+        now = time.time()
+        self._update(now)
+        spent = sum(event[3] for event in self.events if event[0] > now - BURN_WINDOW)
+        return spent * 60 * 60 / BURN_WINDOW
+
+    def endpoint_usage(self):
+        """ Returns a dict of endpoint -> (requests, units) over the last 24 hours """
+        self._update(time.time())
+        usage = {}
+        for _, _, endpoint, cost in self.events:
+            requests, units = usage.get(endpoint, (0, 0))
+            usage[endpoint] = (requests + 1, units + cost)
+        return usage
+
+    def total_remaining(self):
+        now = time.time()
+        return sum(self.remaining(key, now) for key in self.keys)
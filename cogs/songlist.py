@@ -0,0 +1,241 @@
+""" Song list used by the song queues, built for queues of many thousands of songs """
+import bisect
+import random
+
+
+CHUNK_SIZE = 512   # songs per chunk
+CHANGE_LIMIT = 256 # changes logged before take_changes() reports that everything changed
+
+
+class SongList:
+    """ A list of songs stored in chunks.
+
+    Appending, inserting a batch of songs, removing by index and reading by index cost
+    O(log n + CHUNK_SIZE + n / CHUNK_SIZE) instead of O(n) for a plain list, which keeps
+    them flat for the queue sizes plombot sees (tens of thousands of Spotify tracks).
+
+    shuffle() is lazy: it only marks the tail as shuffled, and each song's final spot is
+    drawn (Fisher-Yates) the first time something at or past it is read, so shuffling a
+    huge queue only pays for the songs that actually play or get displayed.
+
+    Every change to the stored order is logged for take_changes(), so the queue
+    snapshots can write just the songs that moved.
+    """
+    def __init__(self, songs=(), chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._chunks = []  # lists of at most chunk_size songs
+        self._offsets = [] # index of the first song of each chunk
+        self._length = 0
+        # Songs in [_shuffle_from, _shuffle_to) still have to be shuffled
+        self._shuffle_from = 0
+        self._shuffle_to = 0
+        # (start, end, count): songs [start, end) were replaced by count songs, None if
+        # more than CHANGE_LIMIT changes were made since take_changes()
+        self._changes = []
+        self.extend(songs)
+
+    def __len__(self):
+        return self._length
+
+    def __bool__(self):
+        return self._length > 0
+
+    def __iter__(self):
+        self._settle(self._length - 1)
+        for chunk in self._chunks:
+            yield from chunk
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._length))]
+        index = self._check_index(index)
+        self._settle(index)
+        chunk, offset = self._locate(index)
+        return self._chunks[chunk][offset]
+
+    def __repr__(self):
+        return f"SongList({list(self)!r})"
+
+    def _check_index(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("song index out of range")
+        return index
+
+    def _locate(self, index):
+        """ Returns (chunk number, index in the chunk) of a song """
+        chunk = bisect.bisect_right(self._offsets, index) - 1
+        return chunk, index - self._offsets[chunk]
+
+    def _update_offsets(self, start=0):
+        """ Recomputes the offsets of the chunks from `start` on """
+        del self._offsets[start:]
+        offset = self._offsets[-1] + len(self._chunks[start - 1]) if start > 0 else 0
+        for chunk in self._chunks[start:]:
+            self._offsets.append(offset)
+            offset += len(chunk)
+
+    def _log(self, start, end, count):
+        changes = self._changes
+        if changes is None:
+            return
+        # Songs added right behind the ones added last, e.g. the batches of an import
+        if changes and start == end == changes[-1][0] + changes[-1][2]:
+            last = changes[-1]
+            changes[-1] = (last[0], last[1], last[2] + count)
+        elif len(changes) >= CHANGE_LIMIT:
+            self._changes = None
+        else:
+            changes.append((start, end, count))
+
+    def _swap(self, a, b):
+        if a == b:
+            return
+        self._log(a, a + 1, 1)
+        self._log(b, b + 1, 1)
+        chunk_a, offset_a = self._locate(a)
+        chunk_b, offset_b = self._locate(b)
+        chunks = self._chunks
+        chunks[chunk_a][offset_a], chunks[chunk_b][offset_b] = chunks[chunk_b][offset_b], chunks[chunk_a][offset_a]
+
+    def _settle(self, index):
+        """ Draws the shuffled songs up to and including index """
+        while self._shuffle_from <= index and self._shuffle_from < self._shuffle_to:
+            self._swap(self._shuffle_from, random.randrange(self._shuffle_from, self._shuffle_to))
+            self._shuffle_from += 1
+
+    def _split(self, chunk):
+        """ Splits a chunk that grew over chunk_size """
+        songs = self._chunks[chunk]
+        if len(songs) > self.chunk_size:
+            self._chunks[chunk:chunk + 1] = [songs[i:i + self.chunk_size]
+                                             for i in range(0, len(songs), self.chunk_size)]
+
+    def append(self, song):
+        self.extend((song,))
+
+    def extend(self, songs):
+        """ Adds songs to the end """
+        songs = list(songs)
+        if not songs:
+            return
+        if not self._chunks:
+            self._chunks.append([])
+        start = len(self._chunks) - 1
+        self._log(self._length, self._length, len(songs))
+        self._chunks[-1].extend(songs)
+        self._split(start)
+        self._length += len(songs)
+        self._update_offsets(start)
+
+    def insert(self, index, songs):
+        """ Inserts songs before index, e.g. position + 1 to play them next """
+        songs = list(songs)
+        index = max(0, min(index, self._length))
+        if not songs:
+            return
+        if index == self._length:
+            self.extend(songs)
+            return
+
+        # Draw the shuffle up to the insertion point, the rest shifts along with it
+        self._settle(index - 1)
+        if index <= self._shuffle_from and self._shuffle_from < self._shuffle_to:
+            self._shuffle_from += len(songs)
+            self._shuffle_to += len(songs)
+
+        self._log(index, index, len(songs))
+        chunk, offset = self._locate(index)
+        self._chunks[chunk][offset:offset] = songs
+        self._split(chunk)
+        self._length += len(songs)
+        self._update_offsets(chunk)
+
+    def pop(self, index=-1):
+        """ Removes and returns the song at index """
+        index = self._check_index(index)
+        self._settle(index)
+        if index < self._shuffle_to:
+            # index < _shuffle_from now, the songs still to be shuffled move down one
+            self._shuffle_from -= 1
+            self._shuffle_to -= 1
+
+        self._log(index, index + 1, 0)
+        chunk, offset = self._locate(index)
+        song = self._chunks[chunk].pop(offset)
+        self._length -= 1
+        if not self._chunks[chunk]:
+            del self._chunks[chunk]
+            chunk = max(0, chunk - 1)
+        if self._chunks:
+            self._update_offsets(chunk)
+        else:
+            self._offsets = []
+        return song
+
+    def shuffle(self, start=0, end=None):
+        """ Shuffles the songs [start, end) (to the end by default), see the class docstring """
+        start = max(0, min(start, self._length))
+        end = self._length if end is None else max(start, min(end, self._length))
+        if start > self._shuffle_from:
+            self._settle(start - 1)
+        self._shuffle_from = start
+        self._shuffle_to = end
+
+    def pending_shuffle(self):
+        """ Returns the (start, end) of the songs that still have to be shuffled """
+        if self._shuffle_from < self._shuffle_to:
+            return self._shuffle_from, self._shuffle_to
+        return 0, 0
+
+    def stored(self, start=0, end=None):
+        """ Returns the songs [start, end) in the order they are stored, without drawing
+        the pending shuffle. Any order of the pending songs is as good as the one they
+        will be drawn in, so this is what the queue snapshots save.
+        """
+        end = self._length if end is None else min(end, self._length)
+        if start >= end:
+            return []
+        songs = []
+        chunk, offset = self._locate(start)
+        while len(songs) < end - start:
+            songs.extend(self._chunks[chunk][offset:offset + end - start - len(songs)])
+            chunk, offset = chunk + 1, 0
+        return songs
+
+    def take_changes(self):
+        """ Returns the changes to the stored order since the last call, oldest first.
+
+        Returns:
+            A list of (start, end, count): the songs [start, end) were replaced by the
+            count songs now at [start, start + count) and the songs after them moved
+            along. None if there were too many changes to keep track of.
+        """
+        changes, self._changes = self._changes, []
+        return changes
+
+
+def changed_ranges(changes):
+    """ Returns the sorted (start, end) ranges of the indexes that hold different songs
+    after a list of take_changes() changes, merged where they touch.
+    """
+    ranges = []
+    for start, end, count in changes:
+        shift = count - (end - start)
+        moved = []
+        for range_start, range_end in ranges:
+            if range_start < start:
+                moved.append((range_start, min(range_end, start)))
+            if range_end > end:
+                moved.append((max(range_start, end) + shift, range_end + shift))
+        if count:
+            moved.append((start, start + count))
+        moved.sort()
+        ranges = []
+        for range_start, range_end in moved:
+            if ranges and range_start <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], range_end))
+            else:
+                ranges.append((range_start, range_end))
+    return ranges
@@ -1,23 +1,210 @@
 """spotify.py - All Spotify related functions go in here """
-import spotipy
+import asyncio
+import base64
+import collections
+import time
+
+import aiohttp
 from discord.ext import commands
-from spotipy.oauth2 import SpotifyClientCredentials
 
 import keys
 from cogs.music import Song
 
+PAGE_CONCURRENCY = 4 # pages of a playlist or album fetched at the same time
+PLAYLIST_PAGE_SIZE = 100 # the most tracks the API returns per playlist page
+ALBUM_PAGE_SIZE = 50     # the most tracks the API returns per album page
+
+API_URL = "https://api.spotify.com/v1/"
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+TOKEN_MARGIN = 60    # seconds before a token expires to fetch a new one
+REQUEST_RATE = 20    # requests per second to the Web API, across all guilds
+REQUEST_BURST = 50   # requests that can start at once after a quiet spell
+MAX_RETRIES = 3      # retries of a request after a 429, a 5xx or a connection error
+RETRY_AFTER = 1      # seconds to back off when a 429 has no Retry-After header
+
+
+class SpotifyException(Exception):
+    """ Raised when the Web API answers with an error """
+    def __init__(self, http_status, msg):
+        super().__init__(f"Spotify error {http_status}: {msg}")
+        self.http_status = http_status
+        self.msg = msg
+
+
+class SpotifyClient:
+    """ Non-blocking Spotify Web API client on the shared HTTP session (see cogs/web.py).
+
+    The client credentials token is cached until TOKEN_MARGIN seconds before it
+    expires, and concurrent requests share a single token request.
+
+    Requests start at most REQUEST_RATE per second (a token bucket of REQUEST_BURST),
+    so a burst of lookups from many guilds is spread out instead of tripping the rate
+    limit. Each request reserves its slot and then runs on its own: a slow response
+    only holds up its caller. A 429 pauses every request until its Retry-After has
+    passed, then the request is retried.
+    """
+    def __init__(self, bot, client_id, client_secret, prefix=API_URL, token_url=TOKEN_URL):
+        self.bot = bot
+        self.prefix = prefix
+        self.token_url = token_url
+        credentials = base64.b64encode(f"{client_id}:{client_secret}".encode()).decode()
+        self._credentials = f"Basic {credentials}"
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = asyncio.Lock()
+        self._tokens = REQUEST_BURST # requests the bucket allows right now
+        self._refilled = time.monotonic()
+        self.blocked_until = 0       # time.monotonic() before which nothing is sent (429)
+
+    async def token(self):
+        """ Returns a client credentials access token, fetching a new one if needed """
+        async with self._token_lock:
+            if self._token is None or time.time() > self._token_expires - TOKEN_MARGIN:
+                status, body, _ = await self.bot.web.request(
+                    "POST", self.token_url, data={"grant_type": "client_credentials"},
+                    headers={"Authorization": self._credentials})
+                if status != 200 or not isinstance(body, dict) or "access_token" not in body:
+                    raise SpotifyException(status, f"could not get a token: {body}")
+                self._token = body["access_token"]
+                self._token_expires = time.time() + body.get("expires_in", 3600)
+            return self._token
+
+    def _reserve(self):
+        """ Takes a slot from the token bucket and returns the seconds to wait for it """
+        now = time.monotonic()
+        self._tokens = min(REQUEST_BURST, self._tokens + (now - self._refilled) * REQUEST_RATE)
+        self._refilled = now
+        self._tokens -= 1
+        delay = -self._tokens / REQUEST_RATE if self._tokens < 0 else 0
+        return max(delay, self.blocked_until - now)
+
+    async def get(self, endpoint, **params):
+        """ GETs a Web API endpoint.
+
+        Args:
+            endpoint: Path under the API prefix, e.g. "tracks/<id>", or a full URL.
+            params: Query parameters, None values are left out.
+        Raises:
+            SpotifyException: If the API answered with an error.
+            asyncio.TimeoutError, aiohttp.ClientError: If it could not be reached.
+        Returns:
+            The decoded JSON response.
+        """
+        url = endpoint if endpoint.startswith("http") else self.prefix + endpoint
+        params = {key: value for key, value in params.items() if value is not None}
+        for attempt in range(MAX_RETRIES + 1):
+            last_attempt = attempt == MAX_RETRIES
+            delay = self._reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            headers = {"Authorization": f"Bearer {await self.token()}"}
+            try:
+                status, body, response_headers = await self.bot.web.request("GET", url, params=params, headers=headers)
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                if last_attempt:
+                    raise
+                await asyncio.sleep(2 ** attempt)
+                continue
+
+            if status == 429 and not last_attempt:
+                # Rate limited: hold back every request, not just this one
+                try:
+                    retry_after = float(response_headers.get("Retry-After", RETRY_AFTER))
+                except ValueError:
+                    retry_after = RETRY_AFTER
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+                print(f"Spotify rate limited, retrying in {retry_after}s")
+                continue
+            if status == 401 and not last_attempt:
+                # Token revoked or expired early
+                self._token = None
+                continue
+            if status >= 500 and not last_attempt:
+                await asyncio.sleep(2 ** attempt)
+                continue
+            if status >= 400:
+                message = body.get("error", {}).get("message") if isinstance(body, dict) else body
+                raise SpotifyException(status, message)
+            return body
+
+    async def search(self, q, type="track", limit=10, offset=0): # pylint: disable=redefined-builtin
+        return await self.get("search", q=q, type=type, limit=limit, offset=offset)
+
+    async def track(self, track_id):
+        return await self.get(f"tracks/{track_id}")
+
+    async def artist_top_tracks(self, artist_id, country="US"):
+        return await self.get(f"artists/{artist_id}/top-tracks", country=country)
+
+    async def album_tracks(self, album_id, limit=50, offset=0):
+        return await self.get(f"albums/{album_id}/tracks", limit=limit, offset=offset)
+
+    async def playlist(self, playlist_id):
+        return await self.get(f"playlists/{playlist_id}")
+
+    async def playlist_tracks(self, playlist_id, limit=100, offset=0):
+        return await self.get(f"playlists/{playlist_id}/tracks", limit=limit, offset=offset)
+
 
 class Spotify(commands.Cog):
     """ Spotify cog """
-    def __init__(self, bot):
+    def __init__(self, bot, client=None):
         self.bot = bot
-        self.client = spotipy.Spotify(
-            client_credentials_manager=SpotifyClientCredentials(
-                client_secret=keys.spotify_secret,
-                client_id=keys.spotify_id
-            ))
-        self.client.trace = False
-        self.client.trace_out = False
+        if client is None:
+            client = SpotifyClient(bot, client_id=keys.spotify_id, client_secret=keys.spotify_secret)
+        self.client = client
+
+    async def iter_pages(self, first_page, fetch_page):
+        """ Yields the items of every page of a Spotify paging object, one page at a time.
+
+        The first page tells how many items there are, the remaining pages are then
+        fetched concurrently, PAGE_CONCURRENCY at a time, and yielded in order.
+
+        Args:
+            first_page: The paging object of the first page.
+            fetch_page: Coroutine function returning the paging object at an offset.
+        """
+        items = first_page.get('items', [])
+        yield items
+        total = first_page.get('total') or len(items)
+        limit = first_page.get('limit') or len(items)
+        if not limit or first_page.get('next') is None:
+            return
+
+        offsets = iter(range(limit, total, limit))
+        pending = collections.deque()
+        try:
+            while True:
+                for offset in offsets:
+                    pending.append(asyncio.ensure_future(fetch_page(offset)))
+                    if len(pending) >= PAGE_CONCURRENCY:
+                        break
+                if not pending:
+                    return
+                page = await pending.popleft()
+                yield page.get('items', [])
+        finally:
+            # The caller stopped early
+            for task in pending:
+                task.cancel()
+
+    async def iter_album_songs(self, album_id):
+        """ Yields the songs of a Spotify Album, one page at a time, see album_to_songs() """
+        playlist = await self.client.album_tracks(album_id, limit=ALBUM_PAGE_SIZE)
+        pages = self.iter_pages(playlist.get('tracks', playlist),
+            lambda offset: self.client.album_tracks(album_id, limit=ALBUM_PAGE_SIZE, offset=offset))
+
+        url = "https://open.spotify.com/album/" + album_id
+        async for tracks in pages:
+            songs = []
+            for track in tracks:
+                song = track_to_song(track)
+                if song is not None:
+                    song.url = url
+                    songs.append(song)
+            await self.match_songs(songs)
+            yield songs
 
     async def album_to_songs(self, album_id):
         """ Converts a Spotify Album ID to a list of Song() objects.
@@ -25,24 +212,14 @@ class Spotify(commands.Cog):
             album_id: The album ID as a string.
         Raises:
             AttributeError: If the album_id is not a string.
-            spotipy.client.SpotifyException: If the album ID is empty or invalid.
+            SpotifyException: If the album ID is empty or invalid.
         Returns:
             A list of Song() objects.
         """
-        playlist = self.client.album_tracks(album_id)
         songs = []
-
-        tracks = playlist.get('tracks', {}).get('items')
-        if tracks is None:
-            tracks = playlist.get('items', [])
-
-        print(tracks)
-
-        for track in tracks:
-            song = track_to_song(track)
-            song.url = "https://open.spotify.com/album/" + album_id
-            songs.append(song)
-
+        async for page in self.iter_album_songs(album_id):
+            songs.extend(page)
+        print(f"Spotify album {album_id}: {len(songs)} songs")
         return songs
 
     async def artist_top_songs(self, artist_id, num_songs=10):
@@ -51,49 +228,75 @@ class Spotify(commands.Cog):
             artist_id: A Spotify Artist ID.
             num_songs: Number of songs to return. Maximum: 10
         Raises:
-            spotipy.client.SpotifyException: If the artist ID is empty or invalid.
+            SpotifyException: If the artist ID is empty or invalid.
         Returns:
             A list of Song() objects.
         """
-        playlist = self.client.artist_top_tracks(artist_id=artist_id)
+        playlist = await self.client.artist_top_tracks(artist_id=artist_id)
         songs = []
         for track in playlist['tracks']:
             song = track_to_song(track)
             songs.append(song)
 
-        return songs[:num_songs]
+        songs = songs[:num_songs]
+        await self.match_songs(songs)
+        return songs
+
+    async def iter_playlist_songs(self, playlist_id):
+        """ Yields the songs of a Spotify Playlist, one page at a time, see playlist_to_songs() """
+        playlist = await self.client.playlist(playlist_id)
+        pages = self.iter_pages(playlist['tracks'],
+            lambda offset: self.client.playlist_tracks(playlist_id, limit=PLAYLIST_PAGE_SIZE, offset=offset))
+
+        url = f"https://open.spotify.com/playlist/{playlist_id}"
+        async for tracks in pages:
+            songs = []
+            for track in tracks:
+                song = track_to_song(track.get('track'))
+                if song is not None:
+                    song.url = url # Replace url with spotify link
+                    songs.append(song)
+            await self.match_songs(songs)
+            yield songs
 
     async def playlist_to_songs(self, playlist_id):
         """ Converts a Spotify Playlist to Song() objects.
         Args:
             playlist_id: A Spotify Playlist ID.
         Raises:
-            spotipy.client.SpotifyException: If the playlist ID is empty or invalid.
+            SpotifyException: If the playlist ID is empty or invalid.
         Returns:
             A list of Song() objects.
         """
-        playlist = self.client._get("playlists/%s" % (playlist_id)) # pylint: disable=protected-access
         songs = []
-
-        for track in playlist['tracks']['items']:
-            song = track_to_song(track.get('track'))
-            if song is not None:
-                song.url = f"https://open.spotify.com/playlist/{playlist_id}" # Replace url with spotify link
-                songs.append(song)
-
+        async for page in self.iter_playlist_songs(playlist_id):
+            songs.extend(page)
+        print(f"Spotify playlist {playlist_id}: {len(songs)} songs")
         return songs
 
+    async def match_songs(self, songs):
+        """ Fills in the YouTube videos already matched to the songs' tracks, with one
+        bulk query, so load_song() does not have to search for them again.
+        """
+        matches = await self.bot.db.find_spotify_matches(song.spotify_id for song in songs)
+        for song in songs:
+            match = matches.get(song.spotify_id)
+            if match is not None:
+                song.youtube_id, song.thumbnail = match
+        if matches:
+            print(f"Matched {len(matches)} of {len(songs)} Spotify tracks from the database")
+
     async def query_to_album(self, query):
         """ Searches Spotify Albums for a given query.
         Args:
             query: A query string.
         Raises:
             IndexError: If the query returned no results.
-            spotipy.client.SpotifyException: If the search query is empty.
+            SpotifyException: If the search query is empty.
         Returns:
             A Spotify Album object
         """
-        results = self.client.search(q=query, type='album')
+        results = await self.client.search(q=query, type='album')
         return results['albums']['items'][0]
 
     async def query_to_artist(self, query):
@@ -102,55 +305,50 @@ class Spotify(commands.Cog):
             query: A query string.
         Raises:
             IndexError: If the query returned no results.
-            spotipy.client.SpotifyException: If the search query is empty.
+            SpotifyException: If the search query is empty.
         Returns:
             A Spotify Artist object
         """
-        results = self.client.search(q=query, type='artist')
+        results = await self.client.search(q=query, type='artist')
         return results['artists']['items'][0]
 
-    async def url_to_songs(self, url):
-        """ Returns a list of Song() objects from a given URL.
+    async def iter_url_songs(self, url):
+        """ Yields the Song() objects of a Spotify URL in batches, as they are fetched.
+        Albums and playlists come one page at a time, so the first songs can be queued
+        before the last page is in.
         Args:
             url: A Spotify URL string.
-        Raises:
-            ?
-        Returns:
-            A list of Song() objects, possibly empty.
         """
-        songs = []
-
         if 'album' in url:
             album_id = get_url_value(url, "album")
             if album_id is not None:
-                for song in await self.album_to_songs(album_id):
-                    songs.append(song)
+                async for songs in self.iter_album_songs(album_id):
+                    yield songs
 
         elif 'artist' in url:
             artist_id = get_url_value(url, "artist")
             if artist_id is not None:
-                for song in await self.artist_top_songs(artist_id):
-                    songs.append(song)
+                yield await self.artist_top_songs(artist_id)
 
         elif 'playlist' in url:
             playlist_id = get_url_value(url, "playlist")
             if playlist_id is not None:
-                for song in await self.playlist_to_songs(playlist_id):
-                    song.url = url
-                    songs.append(song)
+                async for songs in self.iter_playlist_songs(playlist_id):
+                    for song in songs:
+                        song.url = url
+                    yield songs
 
         elif 'track' in url:
             track_id = get_url_value(url, "track")
 
             # Lookup song in database
-            song = self.bot.db.find_song(spotify_id=track_id)
+            song = await self.bot.db.find_song(spotify_id=track_id)
             if song is None:
                 # not cached, look up song via spotify web api
-                track = self.client.track(track_id)
+                track = await self.client.track(track_id)
                 song = track_to_song(track)
-            songs.append(song)
-
-        return songs
+                await self.match_songs([song])
+            yield [song]
 
 def get_url_value(url, key):
     """ Extracts a value from a URL of the form:
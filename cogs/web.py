@@ -0,0 +1,151 @@
+""" Shared HTTP client used by every cog that talks to a web API """
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+from discord.ext import commands
+
+
+CONNECTIONS = 100      # open connections across all hosts
+HOST_CONCURRENCY = 10  # requests in flight to a single host
+DEFAULT_TIMEOUT = 10   # seconds
+TIMEOUTS = {           # seconds, per host
+    "www.googleapis.com": 10,
+    "api.spotify.com": 10,
+    "accounts.spotify.com": 10,
+    "api.opendota.com": 20,
+    "api.genius.com": 10,
+    "genius.com": 15,
+}
+
+# Checks
+async def author_is_plomdawg(ctx):
+    """ Returns True if the author is plomdawg """
+    return ctx.author.id == 163040232701296641
+
+
+class HostStats:
+    """ Request counters for one host """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def average_latency(self):
+        if self.requests == 0:
+            return 0.0
+        return self.total_latency / self.requests
+
+    def record(self, latency, error=False):
+        self.requests += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if error:
+            self.errors += 1
+
+
+class Web(commands.Cog):
+    """ Pooled aiohttp session with per-host concurrency limits and timeouts.
+
+    Keep-alive connections are reused between requests, so most calls skip the
+    TCP/TLS handshake, and a slow host can only tie up HOST_CONCURRENCY requests.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self._session = None
+        self._semaphores = {} # key = host, value = asyncio.Semaphore
+        self.stats = {}       # key = host, value = HostStats
+
+    def cog_unload(self):
+        if self._session is not None:
+            self.bot.loop.create_task(self._session.close())
+
+    @property
+    def session(self):
+        """ The shared aiohttp.ClientSession, created on first use """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=CONNECTIONS, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def request(self, method, url, params=None, headers=None, timeout=None, read="json", data=None):
+        """ Sends a request through the shared session.
+
+        Args:
+            method: HTTP method, e.g. "GET".
+            url: The full URL.
+            params: Optional dict of query parameters.
+            headers: Optional dict of headers.
+            timeout: Seconds before giving up, defaults to the host's entry in TIMEOUTS.
+            read: "json", "text" or "bytes".
+            data: Optional dict sent as a form body.
+        Raises:
+            asyncio.TimeoutError: If the host took longer than the timeout.
+            aiohttp.ClientError: If the connection failed, or a JSON body could not be decoded.
+        Returns:
+            A tuple of (status code, response body, response headers).
+        """
+        host = urlsplit(url).hostname
+        if timeout is None:
+            timeout = TIMEOUTS.get(host, DEFAULT_TIMEOUT)
+        semaphore = self._semaphores.setdefault(host, asyncio.Semaphore(HOST_CONCURRENCY))
+        stats = self.stats.setdefault(host, HostStats())
+
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                async with self.session.request(method, url, params=params, headers=headers, data=data,
+                                                 timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    if read == "json":
+                        try:
+                            body = await response.json(content_type=None)
+                        except ValueError as error:
+                            # e.g. the HTML page of a 5xx or 429
+                            raise aiohttp.ContentTypeError(response.request_info, response.history,
+                                                           status=response.status,
+                                                           message=f"Invalid JSON body: {error}") from error
+                    elif read == "text":
+                        body = await response.text()
+                    else:
+                        body = await response.read()
+            except (asyncio.TimeoutError, aiohttp.ClientError) as error:
+                stats.record(time.perf_counter() - start_time, error=True)
+                print(f"Web.request({method} {host}) failed: {error!r}")
+                raise
+            stats.record(time.perf_counter() - start_time, error=response.status >= 400)
+
+        return response.status, body, response.headers
+
+    async def get_json(self, url, params=None, headers=None, timeout=None):
+        """ GETs a URL and returns the decoded JSON body (also for error responses) """
+        _, body, _ = await self.request("GET", url, params=params, headers=headers, timeout=timeout)
+        return body
+
+    async def get_text(self, url, params=None, headers=None, timeout=None):
+        """ GETs a URL and returns the body as a string """
+        _, body, _ = await self.request("GET", url, params=params, headers=headers, timeout=timeout, read="text")
+        return body
+
+    @commands.command(aliases=["web"])
+    @commands.check(author_is_plomdawg)
+    async def http(self, ctx):
+        """ Sends request counts and latency for each host """
+        text = ""
+        for host, stats in sorted(self.stats.items()):
+            text += f"**{host}** {stats.requests} requests, {stats.errors} errors, " \
+                    f"{stats.average_latency * 1000:.0f}ms avg, {stats.max_latency * 1000:.0f}ms max\n"
+        if not text:
+            text = "No requests yet."
+        await self.bot.send_embed(channel=ctx, title="HTTP Stats", text=text)
+
+
+def setup(bot):
+    bot.add_cog(Web(bot))
+    print("Loaded Web cog")
@@ -1,12 +1,17 @@
 """ Youtube cog """
+import asyncio
 import html
-from urllib.parse import urlencode
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import isodate
-import requests
 import youtube_dl
 from discord.ext import commands
+from cogs.database import normalize_query
 from cogs.music import Song
+from cogs.quota import QuotaManager, save_usage
 
 import keys
 
@@ -19,23 +24,196 @@ OPTIONS = {'format': 'bestaudio/best',
            'no_warnings' : True,
           }
 
+# Only ask for the fields we use, keeps playlist responses small
+PLAYLIST_FIELDS = "nextPageToken,items(snippet(title,resourceId/videoId,thumbnails/high/url))"
+DETAILS_FIELDS = "items(id,contentDetails/duration,snippet/thumbnails/high/url)"
+QUOTA_FLUSH_INTERVAL = 60 # seconds between saves of the API quota usage
+MAX_IDS = 50 # videos endpoint accepts up to 50 ids per request
+
+DOWNLOAD_WORKERS = 3       # youtube-dl downloads running at once
+DOWNLOAD_RATE_LIMIT = None # bytes per second shared by all downloads, None for unlimited
+
+# Checks
+async def author_is_plomdawg(ctx):
+    """ Returns True if the author is plomdawg """
+    return ctx.author.id == 163040232701296641
+
+
+class DownloadJob:
+    """ One video being downloaded, shared by everyone who asked for it """
+    def __init__(self, loop, youtube_id, path, priority):
+        self.youtube_id = youtube_id
+        self.path = path
+        self.temp_path = f"{path}.download" # where the file grows until it is complete
+        self.priority = priority
+        self.future = loop.create_future()
+        self.finished = threading.Event() # set by the worker thread, see StreamingAudio
+        self.started = False
+        self.waiters = 0
+
+
+class DownloadPool:
+    """ Runs youtube-dl downloads on a pool of worker threads.
+
+    Jobs are started in priority order, requests for a video that is already queued
+    or downloading wait for the same job, and at most `workers` downloads run at once,
+    each limited to an equal share of `rate_limit`.
+    """
+    # Priorities, lower runs first
+    NOW_PLAYING = 0
+    PREFETCH = 1
+    WARM_UP = 2
+
+    def __init__(self, loop, workers=DOWNLOAD_WORKERS, rate_limit=DOWNLOAD_RATE_LIMIT):
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="youtube-dl")
+        self.queue = asyncio.PriorityQueue()
+        self.jobs = {} # key = youtube_id, value = DownloadJob
+        self.rate_limit = rate_limit // workers if rate_limit else None
+        self._order = itertools.count() # keeps jobs of the same priority first in, first out
+        self._workers = [loop.create_task(self._work()) for _ in range(workers)]
+
+    async def download(self, youtube_id, path, priority=NOW_PLAYING):
+        """ Downloads a video to path, or waits for the download already in progress.
+
+        Raises:
+            youtube_dl.utils.DownloadError: If the download failed.
+        Returns:
+            The path.
+        """
+        job = self.start(youtube_id, path, priority)
+        job.waiters += 1
+        try:
+            return await asyncio.shield(job.future)
+        finally:
+            job.waiters -= 1
+            # Everybody gave up before it started, drop it
+            if job.waiters == 0 and not job.started and not job.future.done():
+                job.future.cancel()
+                self.jobs.pop(youtube_id, None)
+
+    def start(self, youtube_id, path, priority=NOW_PLAYING):
+        """ Queues a download without waiting for it, and returns its DownloadJob.
+
+        The job can be dropped if nobody calls download() for it before it starts.
+        """
+        job = self.jobs.get(youtube_id)
+        if job is None:
+            job = DownloadJob(self.loop, youtube_id, path, priority)
+            self.jobs[youtube_id] = job
+            self._put(job)
+        elif priority < job.priority and not job.started:
+            # Queue it again at the higher priority, the old entry is skipped
+            job.priority = priority
+            self._put(job)
+        return job
+
+    def _put(self, job):
+        self.queue.put_nowait((job.priority, next(self._order), job))
+
+    async def _work(self):
+        while True:
+            priority, _, job = await self.queue.get()
+            # Skip cancelled jobs and entries replaced by a higher priority
+            if job.started or job.future.done() or priority != job.priority:
+                continue
+
+            job.started = True
+            try:
+                await self.loop.run_in_executor(self.executor, self._download, job)
+                job.future.set_result(job.path)
+            except Exception as error: # pylint: disable=broad-except
+                job.future.set_exception(error)
+            finally:
+                self.jobs.pop(job.youtube_id, None)
+
+    def _download(self, job):
+        """ Downloads a video on a worker thread """
+        try:
+            if os.path.isfile(job.path):
+                return
+            os.makedirs(os.path.dirname(job.path), exist_ok=True)
+
+            # Download next to the final path and move it in place once it is complete.
+            # No .part file, so the audio can be played while it downloads.
+            options = dict(OPTIONS, outtmpl=job.temp_path, nopart=True)
+            if self.rate_limit is not None:
+                options["ratelimit"] = self.rate_limit
+            with youtube_dl.YoutubeDL(options) as downloader:
+                downloader.download([f"https://www.youtube.com/watch?v={job.youtube_id}"])
+            os.replace(job.temp_path, job.path)
+        finally:
+            job.finished.set()
+
+    def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        self.executor.shutdown(wait=False)
+
+
 class YouTube(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.downloader = youtube_dl.YoutubeDL(OPTIONS)
+        self.downloads = DownloadPool(bot.loop)
+        self._searches = {} # key = normalized query, value = asyncio.Future of a search in progress
+        # youtube_keys is a list of keys to rotate through, older keys.py files have one youtube_key
+        self.quota_manager = QuotaManager(getattr(keys, "youtube_keys", None) or [keys.youtube_key])
+        self.quota_loaded = False
+        self.bot.loop.create_task(self.load_quota())
+        self._quota_task = self.bot.loop.create_task(self.run())
 
-    def _get(self, endpoint, params=None):
+    def cog_unload(self):
+        self._quota_task.cancel()
+        self.flush_quota_nowait()
+        self.downloads.close()
+
+    async def load_quota(self):
+        """ Loads the quota usage saved before the last restart """
+        try:
+            rows = await self.bot.db.storage.fetchall("SELECT key_id, day, units, exhausted FROM youtube_quota")
+        except Exception as error: # pylint: disable=broad-except
+            print(f"Failed to load the YouTube quota usage: {error}")
+            rows = []
+        self.quota_manager.restore(rows)
+        self.quota_loaded = True
+
+    async def flush_quota(self):
+        """ Saves the quota usage if it changed """
+        if self.quota_loaded and self.quota_manager.dirty:
+            await self.bot.db.storage.write(save_usage, self.quota_manager.rows())
+
+    def flush_quota_nowait(self):
+        if self.quota_loaded and self.quota_manager.dirty:
+            self.bot.db.storage.submit(save_usage, self.quota_manager.rows())
+
+    async def run(self):
+        """ Saves the quota usage every QUOTA_FLUSH_INTERVAL seconds """
+        while True:
+            await asyncio.sleep(QUOTA_FLUSH_INTERVAL)
+            try:
+                await self.flush_quota()
+            except Exception as error: # pylint: disable=broad-except
+                print(f"Failed to save the YouTube quota usage: {error}")
+
+    async def _get(self, endpoint, params=None):
         """ Makes an authorized request to the desired endpoint.
 
+        The key is picked by the quota_manager. If the API says the key is over its
+        quota, the request is retried with the next key.
+
+        Raises:
+            QuotaExceeded: If no key has enough quota left for the request.
         Returns:
             JSONified response
         """
-        url = f"https://www.googleapis.com/youtube/v3/{endpoint}?key={keys.youtube_key}&"
-        if params:
-            url += urlencode(params)
-        print(f"YouTube._get({url})")
-        response = requests.get(url)
-        return response.json()
+        url = f"https://www.googleapis.com/youtube/v3/{endpoint}"
+        print(f"YouTube._get({endpoint}, {params})")
+        while True:
+            key = self.quota_manager.take(endpoint)
+            results = await self.bot.web.get_json(url, params=dict(params or {}, key=key))
+            if not is_quota_error(results):
+                return results
+            self.quota_manager.exhaust(key)
 
     async def load_song(self, song):
         """
@@ -47,23 +225,21 @@ class YouTube(commands.Cog):
         Either song.query or song.youtube_id must be set for this to work
         Returns the song after updating the fields.
         """
-        # Missing video id, use query to get it (does not set duration)
+        # Missing video id, use query to get it
         if song.youtube_id is None:
-            params = {
-                "part": "snippet",
-                "type": "video",
-                "maxResults": 1,
-                "q": song.query,
-                }
-            results = self._get("search", params=params)
-            item = results.get("items", [{}])[0]
-            snippet = item.get("snippet", {})
-            song.youtube_id = item.get("id", {}).get("videoId")
+            result = await self.search(song.query)
+            if result is None:
+                raise IndexError(f"No YouTube results for {song.query}")
+            youtube_id, title, thumbnail, duration = result
+            song.youtube_id = youtube_id
             if song.title is None:
-                song.title = html.unescape(snippet.get("title", "?"))
-                song.title = song.title.translate(str.maketrans(dict.fromkeys('[]()')))
-            thumbnails = snippet.get("thumbnails", {}).get("high", {})
-            song.thumbnail = thumbnails.get("url", "https://i.imgur.com/MSg2a9d.png")
+                song.title = title
+            song.thumbnail = thumbnail
+            if song.duration is None:
+                song.duration = duration
+            # Remember the match right away, so the track is never searched for again
+            if song.spotify_id is not None:
+                await self.bot.db.save_spotify_match(song.spotify_id, youtube_id, thumbnail)
 
         # If we have the video id, make sure we have these too
         if song.title is None or song.thumbnail is None or song.duration is None:
@@ -71,7 +247,7 @@ class YouTube(commands.Cog):
                 "part": "contentDetails,snippet",
                 "id": song.youtube_id,
                 }
-            results = self._get("videos", params=params)
+            results = await self._get("videos", params=params)
             item = results.get("items", [{}])[0]
             snippet = item.get("snippet", {})
             if song.title is None:
@@ -90,43 +266,134 @@ class YouTube(commands.Cog):
 
         return song
 
-    async def url_to_songs(self, url):
-        """ Returns a list of Song()s from given YouTube URL """
+    async def search(self, query):
+        """ Finds the top YouTube video for a search query.
+
+        Results are cached by normalized query (see Database.searches), and identical
+        searches that are already in progress share one request.
+
+        Returns:
+            A tuple of (youtube_id, title, thumbnail, duration), or None if nothing was found.
+        """
+        query_key = normalize_query(query)
+        result = await self.bot.db.searches.get(query_key)
+        if result is not None:
+            return result
+
+        future = self._searches.get(query_key)
+        if future is None:
+            future = asyncio.ensure_future(self._search(query, query_key))
+            self._searches[query_key] = future
+            future.add_done_callback(lambda _: self._searches.pop(query_key, None))
+        # shield: one caller giving up must not cancel the search for the others
+        return await asyncio.shield(future)
+
+    async def _search(self, query, query_key):
+        """ Searches YouTube and caches the result, see search() """
+        params = {
+            "part": "snippet",
+            "type": "video",
+            "maxResults": 1,
+            "q": query,
+            }
+        results = await self._get("search", params=params)
+        items = results.get("items")
+        if not items:
+            return None
+
+        song = Song()
+        song.youtube_id = items[0].get("id", {}).get("videoId")
+        snippet = items[0].get("snippet", {})
+        song.title = html.unescape(snippet.get("title", "?"))
+        song.title = song.title.translate(str.maketrans(dict.fromkeys('[]()')))
+        song.thumbnail = snippet.get("thumbnails", {}).get("high", {}).get("url", "https://i.imgur.com/MSg2a9d.png")
+
+        # search results have no duration
+        await self.add_video_details([song])
+
+        result = (song.youtube_id, song.title, song.thumbnail, song.duration)
+        await self.bot.db.searches.set(query_key, result)
+        return result
+
+    async def iter_url_songs(self, url):
+        """ Yields the Song()s of a YouTube URL in batches, one per playlist page """
         if 'playlist' in url:
-            songs = await self.playlist_to_songs(url)
+            async for songs in self.iter_playlist_songs(url):
+                yield songs
         else:
-            songs = await self.video_to_songs(url)
-        return songs
+            yield await self.video_to_songs(url)
 
-    async def playlist_to_songs(self, url):
-        """ Returns a list of Song() objects from a given youtube playlist """
-        songs = []
+    async def iter_playlist_songs(self, url):
+        """ Yields the Song() objects of a youtube playlist, one page at a time.
 
+        playlistItems has no durations, so each page of 50 videos is followed by one
+        batched videos request. Pages are linked by tokens and have to be fetched in
+        order, but the videos request for a page runs while the next page is fetched.
+        """
         playlist_id = url.split('list=', 1)[1].split('&', 1)[0]
 
         # Get the list of videos in the playlist
         params = {
-            "part": "contentDetails,snippet",
-            "maxResults": 50,
+            "part": "snippet",
+            "maxResults": MAX_IDS,
             "playlistId": playlist_id,
+            "fields": PLAYLIST_FIELDS,
         }
-        results = self._get("playlistItems", params)
-        # Go through each page of results
-        index = 0
-        while index < results.get("pageInfo", {}).get("totalResults", 0):
-            for item in results.get("items", []):
-                song = self.video_item_to_song(item)
-                songs.append(song)
-                index += 1
-            try:
+        details = None # add_video_details() task of the previous page
+        try:
+            while True:
+                results = await self._get("playlistItems", params)
+                items = results.get("items", [])
+                songs = [self.video_item_to_song(item) for item in items]
+                previous, details = details, asyncio.ensure_future(self.add_video_details(songs))
+                if previous is not None:
+                    yield await previous
+
                 # Get next page using the token
+                if "nextPageToken" not in results or not items:
+                    break
                 params["pageToken"] = results["nextPageToken"]
-                results = self._get("playlistItems", params)
-            except KeyError:
-                # Last page
-                pass
 
-        return songs
+            yield await details
+        finally:
+            # The caller stopped early
+            if details is not None:
+                details.cancel()
+
+    async def add_video_details(self, songs):
+        """ Fills in the duration and thumbnail of songs, MAX_IDS videos per request.
+
+        Returns:
+            The songs that are still available (deleted and private videos are dropped).
+        """
+        available = []
+        for start in range(0, len(songs), MAX_IDS):
+            batch = [song for song in songs[start:start + MAX_IDS] if song.youtube_id is not None]
+            if not batch:
+                continue
+            params = {
+                "part": "contentDetails,snippet",
+                "id": ",".join(song.youtube_id for song in batch),
+                "fields": DETAILS_FIELDS,
+            }
+            results = await self._get("videos", params=params)
+            if "items" not in results:
+                # API error - keep the songs, load_song() will try again at play time
+                available.extend(batch)
+                continue
+            items = {item.get("id"): item for item in results["items"]}
+            for song in batch:
+                item = items.get(song.youtube_id)
+                if item is None:
+                    continue
+                duration = item.get("contentDetails", {}).get("duration")
+                if duration is not None:
+                    song.duration = isodate.parse_duration(duration).total_seconds()
+                thumbnail = item.get("snippet", {}).get("thumbnails", {}).get("high", {}).get("url")
+                if thumbnail is not None:
+                    song.thumbnail = thumbnail
+                available.append(song)
+        return available
 
     async def video_to_songs(self, url):
         """ Converts a video URL to a list containing one Song """
@@ -138,9 +405,7 @@ class YouTube(commands.Cog):
             return []
 
         # Lookup song in database
-        query = f"SELECT title, duration, plays, thumbnail FROM songs WHERE youtube_id = ?"
-        self.bot.db.cursor.execute(query, (youtube_id,))
-        song = self.bot.db.find_song(youtube_id=youtube_id)
+        song = await self.bot.db.find_song(youtube_id=youtube_id)
         if song is None:
             song = Song()
             song.youtube_id = youtube_id
@@ -148,6 +413,28 @@ class YouTube(commands.Cog):
 
         return [song]
 
+    @commands.command()
+    @commands.check(author_is_plomdawg)
+    async def quota(self, ctx):
+        """ Sends the YouTube API quota left on each key and the burn rate """
+        quota = self.quota_manager
+        text = ""
+        for key in quota.keys:
+            remaining = quota.remaining(key)
+            text += f"Key ...{key[-4:]}: **{remaining}** / {quota.daily_quota} units left"
+            if key in quota.exhausted:
+                text += " (out of quota)"
+            text += "\n"
+        burn_rate = quota.burn_rate()
+        total = quota.total_remaining()
+        text += f"Burn rate: **{burn_rate:.0f}** units/hour"
+        if burn_rate > 0:
+            text += f" ({total / burn_rate:.1f} hours left)"
+        text += f"\nRefused: **{quota.refused}** requests\n"
+        for endpoint, (requests, units) in sorted(quota.endpoint_usage().items()):
+            text += f"{endpoint}: {requests} requests, {units} units\n"
+        await self.bot.send_embed(channel=ctx, title="YouTube Quota", text=text)
+
     def video_item_to_song(self, item):
         """ Converts a YouTube response from the videos or playlistItems endpoint to a Song() """
         song = Song()
@@ -155,11 +442,10 @@ class YouTube(commands.Cog):
         thumbnails = snippet.get("thumbnails", {}).get("high", {})
         song.thumbnail = thumbnails.get("url", "https://i.imgur.com/MSg2a9d.png")
 
+        # Left as None when unknown (e.g. playlistItems), so load_song() fetches it
         duration = item.get("contentDetails", {}).get("duration")
         if duration is not None:
             song.duration = isodate.parse_duration(duration).total_seconds()
-        else:
-            song.duration = 0
         song.youtube_id = snippet.get("resourceId", {}).get("videoId")
         if song.youtube_id is None: # ID may be in two different places
             song.youtube_id = item.get("id")
@@ -169,6 +455,11 @@ class YouTube(commands.Cog):
     
 
 
+def is_quota_error(results):
+    """ Returns True if an API response is a quotaExceeded or dailyLimitExceeded error """
+    errors = results.get("error", {}).get("errors", []) if isinstance(results, dict) else []
+    return any(error.get("reason") in ("quotaExceeded", "dailyLimitExceeded") for error in errors)
+
 def setup(bot):
     bot.add_cog(YouTube(bot))
     print("Loaded YouTube cog")
@@ -16,4 +16,6 @@ spotify_id = '04ba9640404bf5d4200510fbea8552d04'
 
 # YouTube enabled API key
 # from https://console.developers.google.com/apis/credentials
-youtube_key = 'Jk4PyICyTPYak2ozB2zaSygQzytUwkGTO3KgEAD'
\ No newline at end of file
+youtube_key = 'Jk4PyICyTPYak2ozB2zaSygQzytUwkGTO3KgEAD'
+# More YouTube keys to rotate through when one runs out of quota (optional)
+youtube_keys = [youtube_key]
@@ -9,6 +9,7 @@ import discord
 from discord.ext import commands
 
 import keys
+from cogs.edits import MessageEditor
 
 
 # Settings
@@ -19,23 +20,14 @@ SUPPORT_SERVER = "https://discord.gg/Czj2g9c"
 logging.getLogger('discord').disabled = True
 
 
-def get_prefix(bot, message):
+async def get_prefix(bot, message):
     if not message.guild:
         prefix = bot.default_prefix
     else:
-        # Check cached prefixes
-        try:
-            prefix = bot.prefixes[message.guild.id]
-        except KeyError:
-            # Load from database
-            bot.db.cursor.execute(f"SELECT prefix FROM guilds WHERE id = '{message.guild.id}'")
-            result = bot.db.cursor.fetchone()
-            if result:
-                prefix = result[0]
-            else:
-                prefix = bot.default_prefix
-            # save to cache
-            bot.prefixes[message.guild.id] = prefix
+        # Served from the guild settings cache
+        prefix = await bot.db.get_guild_setting(message.guild.id, "prefix")
+        if prefix is None:
+            prefix = bot.default_prefix
 
     return prefix
 
@@ -43,16 +35,17 @@ def get_prefix(bot, message):
 class Plombot(commands.Bot):
     def __init__(self, prefix=";"):
         self.default_prefix = prefix
+        self.editors = {} # key = message id, value = MessageEditor with edits in flight
         super().__init__(command_prefix=get_prefix, case_insensitive=True)
         self.load_extension('cogs.admin')
+        self.load_extension('cogs.web')
         self.load_extension('cogs.database')
+        self.load_extension('cogs.cache')
         self.load_extension('cogs.dota')
         self.load_extension('cogs.error_handler')
         self.load_extension('cogs.spotify')
         self.load_extension('cogs.youtube')
         self.load_extension('cogs.music') # must be loaded after spotify/youtube
-        self.db = self.get_cog('Database')
-        self.prefixes = {}
 
         if not discord.opus.is_loaded():
             lib = ctypes.util.find_library('opus')
@@ -129,6 +122,37 @@ class Plombot(commands.Bot):
                 channel = guild.text_channels[0]
             await self.send_help(channel=channel, prefix=DEFAULT_PREFIX)
 
+    @property
+    def db(self):
+        """ The Database cog, looked up each time so it stays valid after a reload """
+        return self.get_cog('Database')
+
+    @property
+    def web(self):
+        """ The Web cog (shared HTTP client) """
+        return self.get_cog('Web')
+
+    @property
+    def audio_cache(self):
+        """ The AudioCache cog (index of downloaded songs) """
+        return self.get_cog('AudioCache')
+
+    async def close(self):
+        """ Saves the queues, closes the connection to Discord and the HTTP client, then writes
+        buffered plays and closes the database
+        """
+        # Before disconnecting from voice, which would move the queues on
+        music = self.get_cog('Music')
+        if music is not None:
+            music.snapshots.flush_nowait()
+        await super().close()
+        await self.web.close()
+        self.audio_cache.flush_nowait()
+        youtube = self.get_cog('YouTube')
+        if youtube is not None:
+            youtube.flush_quota_nowait()
+        self.db.close()
+
     async def send_embed(self, channel, color=None, footer=None, footer_icon=None, subtitle=None,
         subtext=None, text=None, title=None, thumbnail=None):
         """ Sends a message to a channel, and returns the discord.Message of the sent message.
@@ -217,9 +241,27 @@ class Plombot(commands.Bot):
         # Return the last message sent so reactions can be easily added
         return response
 
+    def edit_message(self, message, render):
+        """ Edits a message's embed without waiting, coalescing bursts of edits.
+        See MessageEditor for what render is.
+        """
+        editor = self.editors.get(message.id)
+        if editor is None:
+            editor = MessageEditor(message, on_idle=self._editor_idle)
+            self.editors[message.id] = editor
+        editor.update(render)
+
+    def _editor_idle(self, editor):
+        if self.editors.get(editor.message.id) is editor:
+            del self.editors[editor.message.id]
+
     async def delete_message(self, message):
         """ Deletes a message, ignoring NotFound errors """
         if message is not None:
+            # Drop edits still waiting to be sent
+            editor = self.editors.pop(message.id, None)
+            if editor is not None:
+                editor.cancel()
             try:
                 await message.delete()
             except discord.errors.NotFound:
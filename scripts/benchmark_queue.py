@@ -0,0 +1,82 @@
+""" Benchmarks the song queue operations on queues from 10 to 100k songs.
+
+Compares cogs.songlist.SongList with the plain list SongQueue used before. Each
+column is the average time of one operation in microseconds, it should stay flat
+for SongList as the queue grows.
+
+Usage: python scripts/benchmark_queue.py
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cogs.songlist import SongList # pylint: disable=wrong-import-position
+
+SIZES = [10, 100, 1000, 10000, 100000]
+BATCH = 50     # songs per append/insert, like a small playlist
+REPEATS = 200  # operations timed per cell
+
+
+class Song:
+    """ Stand-in for cogs.music.Song, the queue only stores references """
+    def __init__(self, number):
+        self.title = f"Song {number}"
+
+
+def list_insert(songs, index, batch):
+    # SongQueue.queue(insert=True) before SongList
+    for i, song in enumerate(batch):
+        songs.insert(index + i, song)
+
+def list_shuffle(songs, start):
+    # SongQueue.shuffle() before SongList
+    temp = songs[start:]
+    random.shuffle(temp)
+    songs[start:] = temp
+
+OPERATIONS = {
+    "append": (lambda songs, n, batch: songs.extend(batch),
+               lambda songs, n, batch: songs.extend(batch)),
+    "insert next": (lambda songs, n, batch: list_insert(songs, n // 2, batch),
+                    lambda songs, n, batch: songs.insert(n // 2, batch)),
+    "remove": (lambda songs, n, batch: songs.pop(random.randrange(len(songs) // 2)),
+               lambda songs, n, batch: songs.pop(random.randrange(len(songs) // 2))),
+    "shuffle + next 10": (lambda songs, n, batch: (list_shuffle(songs, n // 2), songs[n // 2:n // 2 + 10]),
+                          lambda songs, n, batch: (songs.shuffle(n // 2), songs[n // 2:n // 2 + 10])),
+    "read": (lambda songs, n, batch: songs[random.randrange(len(songs))],
+             lambda songs, n, batch: songs[random.randrange(len(songs))]),
+}
+
+
+def measure(make, operation, size):
+    """ Returns the average microseconds of one operation on a queue of `size` songs """
+    songs = make(Song(i) for i in range(size))
+    batch = [Song(-i) for i in range(BATCH)]
+    total = 0.0
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        operation(songs, size, batch)
+        total += time.perf_counter() - start
+        # Keep the size steady
+        while len(songs) > size:
+            songs.pop()
+        if len(songs) < size:
+            songs.extend(Song(i) for i in range(size - len(songs)))
+    return total / REPEATS * 1e6
+
+
+def main():
+    random.seed(0)
+    print(f"{'operation':<20}{'songs':>8}{'list (us)':>12}{'SongList (us)':>16}")
+    for name, (list_operation, songlist_operation) in OPERATIONS.items():
+        for size in SIZES:
+            list_time = measure(list, list_operation, size)
+            songlist_time = measure(SongList, songlist_operation, size)
+            print(f"{name:<20}{size:>8}{list_time:>12.1f}{songlist_time:>16.1f}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
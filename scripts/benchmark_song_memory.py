@@ -0,0 +1,81 @@
+""" Measures the memory used by queued songs.
+
+Builds queues of Spotify playlist songs the way Spotify.playlist_to_songs and
+SongQueue.queue do, once with the Song class plombot used before (a __dict__ per
+song and a reference to the requesting discord.User) and once with cogs.music.Song
+(__slots__, interned URLs and the user's id), and reports the bytes per song.
+
+Usage: python scripts/benchmark_song_memory.py
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cogs.music import Song # pylint: disable=wrong-import-position
+
+SIZES = [1000, 10000, 100000]
+PLAYLIST_ID = "37i9dQZF1DXcBWIGoYBM5M"
+
+
+class OldSong:
+    """ cogs.music.Song before __slots__ """
+    def __init__(self):
+        self.title = None
+        self.duration = None
+        self.position = 0
+        self.plays = 0
+        self.query = None
+        self.thumbnail = None
+        self.url = None
+        self.youtube_id = None
+        self.spotify_id = None
+        self.user = None
+
+
+class User:
+    """ Stand-in for the discord.Member who queued the songs """
+    id = 163040232701296641
+
+
+def make_songs(song_class, count, user):
+    songs = []
+    for number in range(count):
+        song = song_class()
+        track_id = f"{number:022d}"
+        song.duration = 200 + number % 100
+        song.title = f"Artist {number % 500} - Track {number}"
+        song.query = song.title
+        song.spotify_id = track_id
+        # One string per song, like the f-string in the playlist loop
+        song.url = f"https://open.spotify.com/playlist/{PLAYLIST_ID}"
+        song.thumbnail = "https://i.imgur.com/MSg2a9d.png"
+        if song_class is OldSong:
+            song.user = user
+        else:
+            song.user_id = user.id
+        songs.append(song)
+    return songs
+
+
+def measure(song_class, count):
+    """ Returns the bytes allocated per song """
+    user = User()
+    tracemalloc.start()
+    songs = make_songs(song_class, count, user)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del songs
+    return size / count
+
+
+def main():
+    print(f"{'songs':>8}{'old (bytes/song)':>20}{'Song (bytes/song)':>20}{'saved':>8}")
+    for count in SIZES:
+        old = measure(OldSong, count)
+        new = measure(Song, count)
+        print(f"{count:>8}{old:>20.0f}{new:>20.0f}{(1 - new / old) * 100:>7.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+""" Benchmarks loading large Spotify playlists.
+
+Serves fake 1k and 10k track playlists from a local stub of the Spotify Web API
+(and its token endpoint), with LATENCY seconds added to every request, and times
+Spotify.playlist_to_songs through SpotifyClient fetching the pages one at a time
+(PAGE_CONCURRENCY = 1) and PAGE_CONCURRENCY at a time. A last run answers one
+request with a 429 to show the cost of a Retry-After.
+
+Usage: python scripts/benchmark_spotify.py
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cogs.spotify # pylint: disable=wrong-import-position
+from cogs.web import Web # pylint: disable=wrong-import-position
+
+SIZES = [1000, 10000]
+LATENCY = 0.1 # seconds per request, about a round trip to api.spotify.com
+PAGE_LIMIT = 100
+RETRY_AFTER = 1 # seconds, sent with the 429
+
+
+def make_track(number):
+    return {
+        'id': f"{number:022d}",
+        'name': f"Track {number}",
+        'duration_ms': 200000,
+        'artists': [{'name': f"Artist {number % 500}"}],
+    }
+
+def make_page(playlist_id, total, offset, limit):
+    """ Returns a paging object of playlist tracks like the Web API does """
+    end = min(offset + limit, total)
+    base = f"/v1/playlists/{playlist_id}/tracks"
+    return {
+        'href': f"{base}?offset={offset}&limit={limit}",
+        'items': [{'track': make_track(number)} for number in range(offset, end)],
+        'limit': limit,
+        'offset': offset,
+        'total': total,
+        'next': f"{base}?offset={end}&limit={limit}" if end < total else None,
+        'previous': None,
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Answers /api/token, /v1/playlists/<size> and /v1/playlists/<size>/tracks """
+    rate_limit_next = False # answer the next playlist request with a 429
+
+    def do_POST(self):
+        time.sleep(LATENCY)
+        self.send_json({'access_token': "stub", 'token_type': "Bearer", 'expires_in': 3600})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        time.sleep(LATENCY)
+        if StubHandler.rate_limit_next:
+            StubHandler.rate_limit_next = False
+            self.send_response(429)
+            self.send_header("Retry-After", str(RETRY_AFTER))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if len(parts) < 3 or parts[1] != "playlists" or not parts[2].isdigit():
+            self.send_error(404)
+            return
+
+        playlist_id = parts[2]
+        total = int(playlist_id)
+        if len(parts) == 3:
+            body = {'id': playlist_id, 'name': f"{total} tracks",
+                    'tracks': make_page(playlist_id, total, 0, PAGE_LIMIT)}
+        else:
+            offset = int(query.get('offset', ['0'])[0])
+            limit = min(int(query.get('limit', [str(PAGE_LIMIT)])[0]), PAGE_LIMIT)
+            body = make_page(playlist_id, total, offset, limit)
+        self.send_json(body)
+
+    def send_json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+
+class Database:
+    """ Stand-in for cogs.database.Database, no matches are stored yet """
+    async def find_spotify_matches(self, spotify_ids):
+        return {}
+
+
+class Bot:
+    """ Stand-in for PlomBot """
+    def __init__(self, loop):
+        self.loop = loop
+        self.db = Database()
+        self.web = Web(self)
+
+
+async def measure(spotify, size):
+    """ Returns the seconds it takes to load a playlist of `size` tracks """
+    start = time.perf_counter()
+    songs = await spotify.playlist_to_songs(str(size))
+    elapsed = time.perf_counter() - start
+    assert len(songs) == size, f"got {len(songs)} songs, expected {size}"
+    return elapsed
+
+
+async def run(port):
+    bot = Bot(asyncio.get_running_loop())
+    client = cogs.spotify.SpotifyClient(bot, "id", "secret", prefix=f"http://127.0.0.1:{port}/v1/",
+                                        token_url=f"http://127.0.0.1:{port}/api/token")
+    spotify = cogs.spotify.Spotify(bot, client=client)
+
+    concurrency = cogs.spotify.PAGE_CONCURRENCY
+    print(f"{'tracks':>8}{'requests':>10}{'sequential (s)':>16}{f'concurrent x{concurrency} (s)':>24}")
+    for size in SIZES:
+        requests = 1 + (size - 1) // PAGE_LIMIT
+        cogs.spotify.PAGE_CONCURRENCY = 1
+        sequential = await measure(spotify, size)
+        cogs.spotify.PAGE_CONCURRENCY = concurrency
+        concurrent = await measure(spotify, size)
+        print(f"{size:>8}{requests:>10}{sequential:>16.2f}{concurrent:>24.2f}")
+
+    StubHandler.rate_limit_next = True
+    rate_limited = await measure(spotify, SIZES[0])
+    print(f"\n{SIZES[0]} tracks with one 429 (Retry-After: {RETRY_AFTER}s): {rate_limited:.2f}s")
+    await bot.web.close()
+
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        asyncio.run(run(server.server_address[1]))
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()